@@ -0,0 +1,215 @@
+"""
+File: asgi.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: ASGI entry point, serves the same routes with the audio streams running on an event loop
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# the flask views still run in threads, but only until they return their response: a response
+# with an async_body attribute (a function returning an async iterator of bytes) is streamed by
+# the event loop, so an open audio download costs a coroutine instead of a thread.
+
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+import asyncio
+import io
+import logging
+import sys
+
+from twitchrss import app as flask_app, warm_up
+
+ASGI_THREADS = 16
+if environ.get('ASGI_THREADS'):
+    ASGI_THREADS = int(environ.get('ASGI_THREADS'))
+
+# runs the flask views and the bodies without an async version, the twitch api and streamlink
+# calls are done here, bounded so that a burst of requests can't spawn unlimited threads
+executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi')
+
+
+def build_environ(scope, body):
+    """returns the WSGI environ of an ASGI http request.
+
+    Args:
+      scope: the ASGI connection scope
+      body: the request body
+
+    Returns: the environ dictionary
+
+    """
+    script_name = scope.get('root_path', '')
+    path = scope['path']
+    if script_name and path.startswith(script_name):
+        path = path[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    wsgi_environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        wsgi_environ['REMOTE_ADDR'], wsgi_environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key in wsgi_environ:
+            value = wsgi_environ[key] + ',' + value
+        wsgi_environ[key] = value
+    return wsgi_environ
+
+
+def dispatch(environ):
+    """runs the flask view of the request, the body of the response is not generated yet.
+
+    Returns: the (response, app_iter, status, headers) tuple
+
+    """
+    with flask_app.request_context(environ):
+        try:
+            response = flask_app.full_dispatch_request()
+        except Exception as e:
+            response = flask_app.handle_exception(e)
+        if getattr(response, 'async_body', None) and response.is_streamed:
+            # the sync body is never sent, and a stream_with_context generator can
+            # only be closed by the thread that created it
+            response.response.close()
+            response.response = iter(())
+    app_iter, status, headers = response.get_wsgi_response(environ)
+    return response, app_iter, status, headers
+
+
+async def wait_disconnect(receive):
+    """returns when the client closes the connection."""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def send_async_body(send, body):
+    """sends the chunks of an async iterator, returns how many bytes were sent."""
+    sent = 0
+    try:
+        async for chunk in body:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                sent += len(chunk)
+    finally:
+        await body.aclose()
+    return sent
+
+
+async def send_app_iter(send, app_iter, disconnected):
+    """sends the chunks of a WSGI body, generating each of them in the executor.
+
+    Returns: how many bytes were sent
+
+    """
+    loop = asyncio.get_event_loop()
+    iterator = iter(app_iter)
+    sent = 0
+    # the iterator can't be interrupted while a thread is generating a chunk,
+    # so it's stopped between two chunks when the client has gone away
+    while not disconnected.done():
+        chunk = await loop.run_in_executor(executor, next, iterator, None)
+        if chunk is None:
+            break
+        if chunk:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            sent += len(chunk)
+    return sent
+
+
+async def lifespan(receive, send):
+    """answers the startup and shutdown events of the server."""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # uvicorn binds the port right after this, streamlink keeps loading meanwhile
+            warm_up()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """the ASGI application."""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        body.extend(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+
+    loop = asyncio.get_event_loop()
+    environ = build_environ(scope, bytes(body))
+    response, app_iter, status, headers = await loop.run_in_executor(executor, dispatch, environ)
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+        async_body = getattr(response, 'async_body', None)
+        if async_body and environ['REQUEST_METHOD'] != 'HEAD' and response.status_code in (200, 206):
+            # async bodies are cancelled as soon as the client goes away, killing their ffmpeg
+            sending = asyncio.ensure_future(send_async_body(send, async_body()))
+            await asyncio.wait([sending, disconnected], return_when=asyncio.FIRST_COMPLETED)
+            if not sending.done():
+                logging.debug("client disconnected, stopping the stream")
+                sending.cancel()
+            try:
+                sent = await sending
+            except asyncio.CancelledError:
+                return
+        else:
+            sent = await send_app_iter(send, app_iter, disconnected)
+        if environ['REQUEST_METHOD'] != 'HEAD' and response.content_length is not None and sent < response.content_length:
+            # a failed transcode: the connection is closed without ending the response so the client sees a short read
+            logging.debug("body ended %d bytes before its Content-Length" % (response.content_length - sent))
+            return
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        disconnected.cancel()
+        # runs the call_on_close callbacks and closes the unused WSGI body
+        if hasattr(app_iter, 'close'):
+            await loop.run_in_executor(executor, app_iter.close)
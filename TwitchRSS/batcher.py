@@ -0,0 +1,109 @@
+"""
+File: batcher.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: coalesces single lookups made by concurrent threads into batched requests
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from concurrent.futures import Future
+from threading import Condition
+import logging
+
+
+class RequestBatcher:
+    """groups the lookups of the same kind made by concurrent threads into one request.
+
+    a lookup is sent right away if no request of its group is running, the lookups asked
+    while one is running wait for it and are then sent together by one of their threads.
+    A single lookup never waits, a burst of them costs one request per round trip instead
+    of one each. No extra threads are used: the waiting threads take turns sending.
+    """
+
+    def __init__(self, fetch, max_batch=100):
+        """
+        Args:
+          fetch: function called as fetch(group, values) returning a dict {value: result},
+                 the values missing from the dict get None
+          max_batch: maximum number of values in one request
+        """
+        self.fetch = fetch
+        self.max_batch = max_batch
+        # for every group the futures of the values waiting to be sent and of the ones being sent
+        self.pending = {}
+        self.sending = {}
+        self.cond = Condition()
+
+    def get(self, group, value):
+        """looks up a single value, batched with the concurrent lookups of the same group.
+
+        Args:
+          group: the kind of lookup, values of different groups are never batched together
+          value: the value to look up
+
+        Returns: the result of fetch for value, or None if it had none
+        Raises: the exception raised by fetch for the whole batch
+
+        """
+        return self.get_many(group, [value])[value]
+
+    def get_many(self, group, values):
+        """looks up several values, batched with the concurrent lookups of the same group.
+
+        Returns: a dict with the result of every value
+        Raises: the exception raised by fetch for the batch of any of the values
+
+        """
+        with self.cond:
+            pending = self.pending.setdefault(group, {})
+            sending = self.sending.get(group, {})
+            futures = {}
+            for value in values:
+                future = sending.get(value) or pending.get(value)
+                if future is None:
+                    future = pending[value] = Future()
+                futures[value] = future
+
+        while True:
+            with self.cond:
+                while True:
+                    if all(future.done() for future in futures.values()):
+                        return {value: future.result() for value, future in futures.items()}
+                    if group not in self.sending and any(pending.get(value) is future for value, future in futures.items()):
+                        break
+                    self.cond.wait()
+                # this thread sends the next batch, its own values first
+                mine = [value for value, future in futures.items() if pending.get(value) is future]
+                others = [value for value in pending if value not in futures]
+                batch = self.sending[group] = {value: pending.pop(value) for value in (mine + others)[:self.max_batch]}
+            try:
+                self._run(group, batch)
+            finally:
+                with self.cond:
+                    del self.sending[group]
+                    self.cond.notify_all()
+
+    def _run(self, group, batch):
+        logging.debug("sending a batch of %d %s lookups" % (len(batch), group))
+        try:
+            results = self.fetch(group, list(batch))
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+            return
+        for value, future in batch.items():
+            future.set_result(results.get(value))
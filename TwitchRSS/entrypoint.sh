@@ -1,3 +1,7 @@
 #!/bin/bash
 
-gunicorn -b :80 -w 1 --threads 5 -k gthread twitchrss:app --env SCRIPT_NAME="$SUB_FOLDER"
+if [ "$SERVER_MODE" = "asgi" ]; then
+    exec uvicorn asgi:app --host 0.0.0.0 --port 80 --workers ${WORKERS:-1} --root-path "$SUB_FOLDER"
+fi
+
+gunicorn -c gunicorn.conf.py -b :80 -w ${WORKERS:-1} --threads ${THREADS:-5} -k gthread twitchrss:app --env SCRIPT_NAME="$SUB_FOLDER"
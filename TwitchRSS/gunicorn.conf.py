@@ -0,0 +1,28 @@
+"""
+File: gunicorn.conf.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: gunicorn hooks, the flags are set in entrypoint.sh
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+def post_worker_init(worker):
+    """the port is already bound by the master, so the worker starts answering
+    while streamlink loads in the background."""
+    import twitchrss
+    twitchrss.warm_up()
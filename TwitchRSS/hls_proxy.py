@@ -0,0 +1,195 @@
+"""
+File: hls_proxy.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: serves the segments of an m3u8 playlist as one continuous stream with byte range support
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import asyncio
+import logging
+
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+import requests
+
+
+class SegmentFetchException(Exception):
+    """raised when a segment can't be downloaded."""
+    pass
+
+
+class HlsProxy:
+    """concatenates the segments of a playlist without ffmpeg.
+
+    the segments are downloaded with a pool of keep-alive connections, prefetch segments
+    ahead of the one being sent are downloaded in parallel so the throughput doesn't depend
+    on the latency of a single request. The size of every segment sent is remembered, once
+    all of them are known the concatenated stream has a known length. Seeking by byte only
+    needs the sizes of the segments before the requested byte, the unknown ones are asked
+    with HEAD requests when a seek needs them.
+    """
+
+    def __init__(self, connections, prefetch, timeout=10, sizes_lifetime=24 * 60 * 60):
+        """
+        Args:
+          connections: maximum number of parallel downloads, shared by all the listeners
+          prefetch: how many segments are downloaded ahead of the one being sent
+          timeout: seconds before a segment download is considered failed
+          sizes_lifetime: seconds the segment sizes of a playlist are remembered
+        """
+        self.connections = connections
+        self.prefetch = prefetch
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections, max_retries=2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = ThreadPoolExecutor(max_workers=connections, thread_name_prefix='hls-proxy')
+        self.sizes = TTLCache(maxsize=500, ttl=sizes_lifetime)
+        self.sizes_lock = Lock()
+
+    def _fetch(self, uri):
+        try:
+            response = self.session.get(uri, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise SegmentFetchException("could not download segment %s: %s" % (uri, e))
+        return response.content
+
+    def _size(self, uri):
+        try:
+            response = self.session.head(uri, timeout=self.timeout, allow_redirects=True)
+            response.raise_for_status()
+            return int(response.headers['Content-Length'])
+        except (requests.RequestException, KeyError, ValueError):
+            # some servers don't answer HEAD requests properly, the full download always works
+            return len(self._fetch(uri))
+
+    def _learn(self, key, count, index, size):
+        with self.sizes_lock:
+            sizes = self.sizes.get(key)
+            if sizes is None or len(sizes) != count:
+                sizes = self.sizes[key] = [None] * count
+            sizes[index] = size
+
+    def known_sizes(self, key, count):
+        """returns the sizes in bytes of the segments of the playlist, None for the ones never seen.
+
+        Args:
+          key: identifies the playlist, like its url
+          count: the number of segments
+
+        """
+        with self.sizes_lock:
+            sizes = self.sizes.get(key)
+            return list(sizes) if sizes is not None and len(sizes) == count else [None] * count
+
+    def probe(self, key, uris, last_byte):
+        """asks the sizes of the segments up to the one containing last_byte and of the prefetch segments
+        after it, skipping the ones already known. The requests run in parallel, a batch at a time,
+        until the sizes reach last_byte, so the cost grows with the requested position and not with
+        the length of the playlist.
+
+        Args:
+          key: identifies the playlist, like its url
+          uris: the absolute uris of the segments
+          last_byte: the byte the known sizes have to reach
+
+        Returns: the sizes like known_sizes()
+
+        """
+        sizes = self.known_sizes(key, len(uris))
+
+        def ask(indexes):
+            for i, size in zip(indexes, self.pool.map(self._size, [uris[i] for i in indexes])):
+                self._learn(key, len(uris), i, size)
+                sizes[i] = size
+            if indexes:
+                logging.debug("asked the size of %d segments of %s" % (len(indexes), key))
+
+        index = total = 0
+        while index < len(uris) and total <= last_byte:
+            if sizes[index] is None:
+                ask([i for i in range(index, min(index + self.connections, len(uris))) if sizes[i] is None])
+            total += sizes[index]
+            index += 1
+        ask([i for i in range(index, min(index + self.prefetch, len(uris))) if sizes[i] is None])
+        return sizes
+
+    def stream(self, key, uris, sizes, first_byte, last_byte=None):
+        """yields the bytes first_byte..last_byte (inclusive) of the concatenated segments,
+        the size of every segment downloaded is remembered.
+
+        Args:
+          key: identifies the playlist, like its url
+          uris: the absolute uris of the segments
+          sizes: the sizes returned by known_sizes() or probe(), known up to last_byte
+          first_byte: first byte to send
+          last_byte: last byte to send, None to send until the end of the playlist
+
+        """
+        for future, index, start, end in self._downloads(uris, sizes, first_byte, last_byte):
+            data = future.result()
+            self._learn(key, len(uris), index, len(data))
+            yield data[start:end]
+
+    async def astream(self, key, uris, sizes, first_byte, last_byte=None):
+        """async version of stream(), waiting for a segment doesn't block the event loop."""
+        downloads = self._downloads(uris, sizes, first_byte, last_byte)
+        try:
+            for future, index, start, end in downloads:
+                data = await asyncio.wrap_future(future)
+                self._learn(key, len(uris), index, len(data))
+                yield data[start:end]
+        finally:
+            downloads.close()
+
+    def _downloads(self, uris, sizes, first_byte, last_byte):
+        """yields a (future, index, start, end) tuple for every segment in the range, the bytes
+        start:end of the segment downloaded by the future have to be sent, end is None for the
+        whole segment. The next prefetch segments are already downloading when a future is yielded."""
+        index = offset = 0
+        while index < len(uris) and sizes[index] is not None and offset + sizes[index] <= first_byte:
+            offset += sizes[index]
+            index += 1
+        skip = first_byte - offset
+        remaining = None if last_byte is None else last_byte - first_byte + 1
+
+        pending = deque()
+        next_index = index
+        try:
+            while remaining is None or remaining > 0:
+                while next_index < len(uris) and len(pending) <= self.prefetch:
+                    pending.append(self.pool.submit(self._fetch, uris[next_index]))
+                    next_index += 1
+                if not pending:
+                    return
+                if remaining is None:
+                    end = None
+                else:
+                    end = min(sizes[index], skip + remaining)
+                    remaining -= end - skip
+                yield pending.popleft(), index, skip, end
+                skip = 0
+                index += 1
+        finally:
+            for future in pending:
+                future.cancel()
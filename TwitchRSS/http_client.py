@@ -0,0 +1,136 @@
+"""
+File: http_client.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: shared HTTP client with keep-alive connections, retries and per-endpoint latency counters
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from threading import Lock
+from urllib.parse import urlsplit
+import logging
+import random
+import time
+
+from requests.adapters import HTTPAdapter
+import requests
+
+# status codes worth another try, the others won't change by asking again.
+# 429 is not retried here: waiting for the rate limit to reset is up to the caller
+RETRY_STATUSES = {500, 502, 503, 504}
+
+
+class HttpRequestException(Exception):
+    """raised when a request still fails after all the retries."""
+
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+
+
+class HttpClient:
+    """thread safe HTTP client shared by all the requests to the same servers.
+
+    the connections are kept alive and reused, so only the first request to a host pays for
+    the TCP and TLS handshakes. Connection errors, timeouts and 5xx responses are retried
+    with exponential backoff and full jitter, so that the workers don't retry all at once.
+    The latency of every endpoint (the path of the url) is counted and available with stats().
+    """
+
+    def __init__(self, connections=10, timeout=3, retries=3, backoff=0.2, max_backoff=5, observe=None):
+        """
+        Args:
+          connections: maximum number of connections kept open for each host
+          timeout: seconds before a connection or a read is considered failed
+          retries: how many times a request is tried before giving up
+          backoff: base delay in seconds between two tries, doubled at every try
+          max_backoff: maximum delay in seconds between two tries
+          observe: optional function called with the endpoint and the seconds of every try
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.observe = observe
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.counters = {}
+        self.counters_lock = Lock()
+
+    def _count(self, endpoint, seconds, failed, retry):
+        with self.counters_lock:
+            counter = self.counters.setdefault(endpoint, {'requests': 0, 'errors': 0, 'retries': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            counter['requests'] += 1
+            counter['errors'] += 1 if failed else 0
+            counter['retries'] += 1 if retry else 0
+            counter['seconds'] += seconds
+            counter['max_seconds'] = max(counter['max_seconds'], seconds)
+        if self.observe:
+            self.observe(endpoint, seconds)
+
+    def _sleep(self, attempt):
+        time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def request(self, method, url, **kwargs):
+        """sends a request, retrying on connection errors, timeouts and 5xx responses.
+
+        Args:
+          method: the HTTP method
+          url: the full url
+          kwargs: passed to requests, like headers or data
+
+        Returns: the successful requests.Response
+        Raises: HttpRequestException if the request failed every time or got a client error
+
+        """
+        endpoint = urlsplit(url).path
+        response = None
+        for attempt in range(self.retries):
+            if attempt:
+                self._sleep(attempt)
+            start = time.time()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._count(endpoint, time.time() - start, True, attempt > 0)
+                logging.warning("request to %s failed: %s" % (endpoint, e))
+                continue
+            failed = response.status_code >= 400
+            self._count(endpoint, time.time() - start, failed, attempt > 0)
+            if not failed:
+                return response
+            logging.warning("request to %s failed with code %d" % (endpoint, response.status_code))
+            logging.warning(response.text)
+            if response.status_code not in RETRY_STATUSES:
+                break
+        raise HttpRequestException("could not get %s" % endpoint, response)
+
+    def get(self, url, **kwargs):
+        """sends a GET request, see request()."""
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """sends a POST request, see request()."""
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """returns a copy of the counters of every endpoint: number of requests, failed requests,
+        retried requests, total and maximum seconds spent waiting for a response."""
+        with self.counters_lock:
+            return {endpoint: dict(counter) for endpoint, counter in self.counters.items()}
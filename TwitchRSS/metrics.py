@@ -0,0 +1,172 @@
+"""
+File: metrics.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: counters and histograms exposed in the Prometheus text format
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from bisect import bisect_left
+from threading import Lock
+import logging
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds, from a cached lookup to a slow twitch request
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """base of the metrics, every metric is added to the registry when it's created."""
+
+    type = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        """
+        Args:
+          name: the metric name
+          description: the HELP text
+          labels: names of the labels, their values are given in the same order when recording
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = Lock()
+        registry.append(self)
+
+    def header(self):
+        return ['# HELP %s %s' % (self.name, self.description), '# TYPE %s %s' % (self.name, self.type)]
+
+    def samples(self):
+        """returns the text lines of the current values."""
+        return []
+
+
+class Counter(Metric):
+    """a value that only goes up."""
+
+    type = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        super().__init__(name, description, labels)
+        self.values = {}
+
+    def inc(self, amount=1, *label_values):
+        """adds amount to the counter of the given label values."""
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return ['%s%s %s' % (self.name, _labels(self.labels, key), _number(value)) for key, value in values]
+
+
+class Histogram(Metric):
+    """counts the observed values in cumulative buckets, with their sum and count."""
+
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        Args:
+          name: the metric name
+          description: the HELP text
+          labels: names of the labels
+          buckets: sorted upper bounds of the buckets, +Inf is added
+        """
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        """records one value for the given label values."""
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                # one count per bucket plus +Inf, then the sum
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, list(counts)) for key, counts in self.values.items())
+        lines = []
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                lines.append('%s_bucket%s %d' % (self.name, _labels(self.labels, key, 'le="%s"' % _number(bound)), total))
+            lines.append('%s_sum%s %s' % (self.name, _labels(self.labels, key), _number(counts[-1])))
+            lines.append('%s_count%s %d' % (self.name, _labels(self.labels, key), total))
+        return lines
+
+
+class Collected(Metric):
+    """a metric read from somewhere else only when the metrics are rendered,
+    so it costs nothing to the code that updates the values."""
+
+    def __init__(self, name, description, type, labels, collect):
+        """
+        Args:
+          name: the metric name
+          description: the HELP text
+          type: 'gauge' or 'counter'
+          labels: names of the labels
+          collect: function returning a list of (label_values, value) tuples
+        """
+        super().__init__(name, description, labels)
+        self.type = type
+        self.collect = collect
+
+    def samples(self):
+        return ['%s%s %s' % (self.name, _labels(self.labels, key), _number(value)) for key, value in self.collect()]
+
+
+def render():
+    """returns every registered metric in the Prometheus text format."""
+    lines = []
+    for metric in registry:
+        try:
+            samples = metric.samples()
+        except Exception as e:
+            # a broken collector must not hide the other metrics
+            logging.error("could not collect metric %s: %s" % (metric.name, e))
+            continue
+        lines.extend(metric.header())
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
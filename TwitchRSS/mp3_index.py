@@ -0,0 +1,163 @@
+"""
+File: mp3_index.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: maps the bytes of a CBR mp3 to the time and the m3u8 segments of the vod it's transcoded from
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from bisect import bisect_right
+import math
+
+# bitrate tables of layer III in kbit/s, the position is the bitrate index of the frame header
+MPEG1_BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+MPEG2_BITRATES = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+MPEG1_SAMPLE_RATES = [44100, 48000, 32000]
+MPEG2_SAMPLE_RATES = [22050, 24000, 16000]
+
+
+class Mp3Layout:
+    """byte layout of a CBR mp3 without ID3/Xing headers and without bit reservoir.
+
+    with a sample rate that doesn't need padding (48000, 32000, 24000, 16000 Hz) every frame
+    has the same size and decodes on its own, so byte N of the file is always inside frame
+    N // frame_bytes and any frame boundary can be the start of a new encode.
+    """
+
+    def __init__(self, bitrate, sample_rate=48000, channels=2):
+        """
+        Args:
+          bitrate: bitrate in bit/s, one of the layer III bitrates
+          sample_rate: sample rate in Hz, one of 48000, 32000, 24000 or 16000
+          channels: 1 for mono, 2 for stereo
+        """
+        if sample_rate not in (48000, 32000, 24000, 16000):
+            raise ValueError("unsupported mp3 sample rate %s, use 48000, 32000, 24000 or 16000" % sample_rate)
+        self.mpeg1 = sample_rate in MPEG1_SAMPLE_RATES
+        bitrates = MPEG1_BITRATES if self.mpeg1 else MPEG2_BITRATES
+        if bitrate % 1000 or bitrate // 1000 not in bitrates[1:]:
+            raise ValueError("unsupported mp3 bitrate %s at %d Hz, use one of %s kbit/s" % (bitrate, sample_rate, bitrates[1:]))
+        if channels not in (1, 2):
+            raise ValueError("unsupported number of channels %s, use 1 or 2" % channels)
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frame_samples = 1152 if self.mpeg1 else 576
+        self.frame_bytes = self.frame_samples // 8 * bitrate // sample_rate
+        self.frame_duration = self.frame_samples / sample_rate
+        self._silent_frame = None
+
+    def length(self, duration):
+        """returns the size in bytes of the mp3 of a duration seconds long audio."""
+        return math.ceil(duration / self.frame_duration) * self.frame_bytes
+
+    def frame_at(self, byte):
+        """returns the index of the frame containing the given byte."""
+        return byte // self.frame_bytes
+
+    def time_at(self, byte):
+        """returns the start time in seconds of the frame containing the given byte."""
+        return self.frame_at(byte) * self.frame_duration
+
+    def silent_frame(self):
+        """returns one frame of silence: a valid header followed by empty side info and main data."""
+        if self._silent_frame is None:
+            bitrates = MPEG1_BITRATES if self.mpeg1 else MPEG2_BITRATES
+            sample_rates = MPEG1_SAMPLE_RATES if self.mpeg1 else MPEG2_SAMPLE_RATES
+            header = 0xFFE00000                                # frame sync
+            header |= (0b11 if self.mpeg1 else 0b10) << 19     # MPEG version
+            header |= 0b01 << 17                               # layer III
+            header |= 1 << 16                                  # no CRC
+            header |= bitrates.index(self.bitrate // 1000) << 12
+            header |= sample_rates.index(self.sample_rate) << 10
+            header |= (0b00 if self.channels == 2 else 0b11) << 6
+            self._silent_frame = header.to_bytes(4, 'big') + bytes(self.frame_bytes - 4)
+        return self._silent_frame
+
+    def silence(self, offset, size):
+        """returns size bytes of a stream of silent frames starting at the absolute byte offset,
+        used to fill the end of a transcode that came out shorter than its advertised length."""
+        frame = self.silent_frame()
+        start = offset % self.frame_bytes
+        frames = math.ceil((start + size) / self.frame_bytes)
+        return (frame * frames)[start:start + size]
+
+
+class PlaylistIndex:
+    """duration and segments of a twitch m3u8 playlist with the cumulative start time of every segment."""
+
+    def __init__(self, segments, duration=None, complete=True):
+        """
+        Args:
+          segments: list of (absolute_uri, duration) tuples
+          duration: total duration, the sum of the segments if None
+          complete: False if the playlist has no #EXT-X-ENDLIST, the vod is still being recorded and will grow
+        """
+        self.uris = [uri for uri, _ in segments]
+        self.durations = [seconds for _, seconds in segments]
+        self.offsets = []
+        total = 0
+        for seconds in self.durations:
+            self.offsets.append(total)
+            total += seconds
+        self.duration = float(duration) if duration is not None else total
+        self.complete = complete
+
+    @classmethod
+    def load(cls, m3u8_url):
+        """downloads and parses the playlist.
+
+        Args:
+          m3u8_url: the url of the audio playlist
+
+        Returns: the PlaylistIndex of the playlist
+
+        """
+        # imported here, it's only needed by the audio routes and takes a while to load
+        import m3u8
+
+        def get_duration_m3u8(line, lineno, data, state):
+            if line.startswith('#EXT-X-TWITCH-TOTAL-SECS'):
+                custom_tag = line.split(':')
+                data['duration'] = custom_tag[1].strip()
+
+        playlist = m3u8.load(m3u8_url, custom_tags_parser=get_duration_m3u8)
+        segments = [(segment.absolute_uri, segment.duration) for segment in playlist.segments]
+        return cls(segments, playlist.data.get('duration'), playlist.is_endlist)
+
+    def segment_at(self, seconds):
+        """finds the segment playing at the given time.
+
+        Args:
+          seconds: time from the start of the vod
+
+        Returns: a (segment_index, seconds_from_segment_start) tuple
+
+        """
+        index = max(bisect_right(self.offsets, seconds) - 1, 0)
+        return index, seconds - self.offsets[index]
+
+    def playlist_from(self, index):
+        """returns the text of a playlist with only the segments from index on,
+        so that ffmpeg starts downloading from the right segment instead of seeking from the first one."""
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-PLAYLIST-TYPE:VOD",
+                 "#EXT-X-TARGETDURATION:%d" % math.ceil(max(self.durations[index:], default=0))]
+        for uri, seconds in zip(self.uris[index:], self.durations[index:]):
+            lines.append("#EXTINF:%.3f," % seconds)
+            lines.append(uri)
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,148 @@
+"""
+File: persistent_cache.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: SQLite backed TTL cache that survives restarts and is shared between gunicorn workers
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from collections.abc import MutableMapping
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+# how many writes to wait before removing expired and exceeding entries
+PRUNE_EVERY = 50
+
+
+class PersistentTTLCache(MutableMapping):
+    """drop-in replacement of cachetools.TTLCache stored in a SQLite database.
+
+    every process opening the same file sees the same entries, so all the gunicorn
+    workers share one warm cache and nothing is lost when the server restarts.
+    Keys must have a stable repr (the cachetools hashkey of strings and ints has one),
+    keys and values must be picklable.
+    """
+
+    def __init__(self, path, namespace, maxsize, ttl):
+        """
+        Args:
+          path: the SQLite database file, created if missing
+          namespace: name that separates this cache from the others stored in the same file
+          maxsize: maximum number of entries kept, the ones closest to expire are dropped first
+          ttl: seconds an entry is valid for
+        """
+        self.path = path
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache ("
+                         "namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, expires REAL NOT NULL, "
+                         "PRIMARY KEY (namespace, key))")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (namespace, expires)")
+            # the repr is what the lookups match, the pickled key is what iterating returns
+            if 'pickled_key' not in [column[1] for column in conn.execute("PRAGMA table_info(cache)")]:
+                try:
+                    conn.execute("ALTER TABLE cache ADD COLUMN pickled_key BLOB")
+                    # the entries of the older versions can't be listed, it's only a cache so they are dropped
+                    conn.execute("DELETE FROM cache WHERE pickled_key IS NULL")
+                except sqlite3.OperationalError:
+                    # another worker added it first
+                    pass
+        logging.debug("persistent cache %s opened with %d entries" % (namespace, len(self)))
+
+    def _connection(self):
+        """returns the SQLite connection of the calling thread, sqlite3 connections can't be shared."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _key(key):
+        return repr(key)
+
+    def __getitem__(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires > ?",
+            (self.namespace, self._key(key), time.time())).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key, value):
+        self.set(key, value, self.ttl)
+
+    def set(self, key, value, ttl):
+        """stores value with a custom time to live instead of the cache default one.
+
+        Args:
+          key: the key
+          value: the picklable value
+          ttl: seconds the entry is valid for
+        """
+        self._connection().execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, pickled_key, value, expires) VALUES (?, ?, ?, ?, ?)",
+            (self.namespace, self._key(key), pickle.dumps(key, pickle.HIGHEST_PROTOCOL),
+             pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.time() + ttl))
+        self._writes += 1
+        if self._writes % PRUNE_EVERY == 0:
+            self.expire()
+
+    def __delitem__(self, key):
+        cursor = self._connection().execute(
+            "DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, self._key(key)))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __iter__(self):
+        rows = self._connection().execute(
+            "SELECT pickled_key FROM cache WHERE namespace = ? AND expires > ?", (self.namespace, time.time())).fetchall()
+        return iter([pickle.loads(row[0]) for row in rows])
+
+    def __len__(self):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM cache WHERE namespace = ? AND expires > ?",
+            (self.namespace, time.time())).fetchone()[0]
+
+    def __contains__(self, key):
+        return self._connection().execute(
+            "SELECT 1 FROM cache WHERE namespace = ? AND key = ? AND expires > ?",
+            (self.namespace, self._key(key), time.time())).fetchone() is not None
+
+    def clear(self):
+        """removes every entry of the namespace."""
+        self._connection().execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+
+    def expire(self):
+        """removes the expired entries and the ones exceeding maxsize."""
+        conn = self._connection()
+        conn.execute("DELETE FROM cache WHERE namespace = ? AND expires <= ?", (self.namespace, time.time()))
+        conn.execute("DELETE FROM cache WHERE namespace = ? AND key IN ("
+                     "SELECT key FROM cache WHERE namespace = ? ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+                     (self.namespace, self.namespace, self.maxsize))
@@ -0,0 +1,185 @@
+"""
+File: pretranscoder.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: transcodes the new vods of the watched channels to the transcode cache before anyone listens to them
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
+import calendar
+import logging
+import os
+import time
+
+
+class Pretranscoder:
+    """writes the transcode of the new vods of the watched channels to the transcode cache.
+
+    a channel is watched for watch_window seconds after its transcoded feed was requested with a
+    profile, every vod list seen for it afterwards is checked for vods that were never transcoded
+    with the profiles it's watched with. Those are
+    transcoded at full speed by low priority ffmpeg processes, at most workers at the same time,
+    so the first listener gets a complete file with instant seeking.
+
+    The files written here that nobody has played yet are kept under max_bytes by deleting the
+    oldest of them, once a file is played it's a normal cache file evicted by the TranscodeCache.
+    """
+
+    def __init__(self, cache, prepare, workers, max_bytes, niceness, watch_window, max_age):
+        """
+        Args:
+          cache: the TranscodeCache the files are written to
+          prepare: function called as prepare(vod_id, profile) returning a (name, command, size, finalize) tuple:
+                   the cache file name, the ffmpeg command, the expected size in bytes and the
+                   finalize function passed to TranscodeCache.start()
+          workers: maximum number of ffmpeg processes running at the same time
+          max_bytes: disk space used by the files nobody has played yet
+          niceness: the nice value of the ffmpeg processes, 19 is the lowest priority
+          watch_window: channels are not watched anymore this many seconds after their last request
+          max_age: vods created more than this many seconds ago are not transcoded
+        """
+        self.cache = cache
+        self.prepare = prepare
+        self.max_bytes = max_bytes
+        self.niceness = niceness
+        self.watch_window = watch_window
+        self.max_age = max_age
+        self.watched = {}
+        # (vod_id, profile) -> creation time of the vod, forgotten once the vod is older than max_age
+        self.seen = {}
+        self.pending = set()
+        # name -> (mtime, size) of the complete files not played yet, the oldest first
+        self.unplayed = {}
+        # name -> expected size of the files being written
+        self.writing = {}
+        self.lock = Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pretranscode')
+
+    def watch(self, channel_id, profile):
+        """records a request of the transcoded feed of the channel with the given transcode profile."""
+        with self.lock:
+            self.watched.setdefault(channel_id, {})[profile] = time.time()
+
+    def notice(self, channel_id, vods, live_stream_ids=()):
+        """queues the vods of a watched channel that were never seen before with its recently requested profiles.
+
+        Args:
+          channel_id: the unique identifier of the channel
+          vods: the vods of the channel as returned by the helix API
+          live_stream_ids: ids of the streams still live, their vods are not finished yet and are checked again later
+
+        """
+        now = time.time()
+        with self.lock:
+            profiles = self.watched.get(channel_id)
+            if profiles is None:
+                return
+            for profile, last_watch in list(profiles.items()):
+                if last_watch + self.watch_window < now:
+                    logging.debug("stopped pre-transcoding %s with profile %s, no recent requests" % (channel_id, profile))
+                    del profiles[profile]
+            if not profiles:
+                del self.watched[channel_id]
+                return
+            for seen, created in list(self.seen.items()):
+                if created + self.max_age < now:
+                    # the age check below skips the vod if it shows up again
+                    del self.seen[seen]
+            for vod in vods:
+                if vod.get('stream_id') in live_stream_ids or all((vod['id'], profile) in self.seen for profile in profiles):
+                    continue
+                created = calendar.timegm(time.strptime(vod['created_at'], '%Y-%m-%dT%H:%M:%SZ'))
+                if created + self.max_age < now:
+                    continue
+                for profile in profiles:
+                    if (vod['id'], profile) in self.seen:
+                        continue
+                    self.seen[(vod['id'], profile)] = created
+                    logging.info("queued pre-transcode of new vod %s with profile %s" % (vod['id'], profile))
+                    self.pending.add((vod['id'], profile))
+                    self.pool.submit(self._transcode, vod['id'], profile)
+
+    def queued(self):
+        """returns how many vods are waiting or being transcoded."""
+        with self.lock:
+            return len(self.pending)
+
+    def _transcode(self, vod_id, profile):
+        start = time.time()
+        try:
+            name, command, size, finalize = self.prepare(vod_id, profile)
+            if not self.cache.needs_writer(name):
+                return
+            if not self._make_room(name, size):
+                logging.warning("not pre-transcoding %s, %d bytes don't fit in the quota" % (vod_id, size))
+                return
+            done = Event()
+            try:
+                process = self.cache.start(name, ['nice', '-n', str(self.niceness)] + command, finalize=finalize,
+                                           on_exit=lambda process: done.set())
+                if process is None:
+                    return
+                done.wait()
+            finally:
+                with self.lock:
+                    self.writing.pop(name, None)
+            try:
+                stat = os.stat(self.cache.path(name))
+            except FileNotFoundError:
+                logging.warning("pre-transcode of %s failed" % vod_id)
+                return
+            with self.lock:
+                self.unplayed[name] = (stat.st_mtime, stat.st_size)
+            logging.info("pre-transcoded %s in %.2fs" % (vod_id, time.time() - start))
+        except Exception as e:
+            logging.warning("could not pre-transcode %s: %s" % (vod_id, e))
+        finally:
+            with self.lock:
+                self.pending.discard((vod_id, profile))
+
+    def _make_room(self, name, size):
+        """deletes the oldest unplayed files until size more bytes fit in max_bytes, then reserves them for name.
+
+        Returns: False if the file can't fit
+
+        """
+        if size > self.max_bytes:
+            return False
+        with self.lock:
+            for old_name, (mtime, _) in list(self.unplayed.items()):
+                try:
+                    # the cache marks the files it serves as recently used
+                    if os.stat(self.cache.path(old_name)).st_mtime != mtime:
+                        del self.unplayed[old_name]
+                except FileNotFoundError:
+                    del self.unplayed[old_name]
+            total = sum(file_size for _, file_size in self.unplayed.values()) + sum(self.writing.values())
+            for old_name in list(self.unplayed):
+                if total + size <= self.max_bytes:
+                    break
+                logging.info("deleting unplayed pre-transcode to stay in the quota: " + old_name)
+                try:
+                    os.remove(self.cache.path(old_name))
+                except FileNotFoundError:
+                    pass
+                total -= self.unplayed.pop(old_name)[1]
+            if total + size > self.max_bytes:
+                return False
+            self.writing[name] = size
+        return True
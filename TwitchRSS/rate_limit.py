@@ -0,0 +1,172 @@
+"""
+File: rate_limit.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: token bucket rate limiter, optionally shared by all the workers through a SQLite database
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from threading import Lock
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+class RateLimitedException(Exception):
+    """raised when a request can't be sent without exceeding the rate limit."""
+    pass
+
+
+class TokenBucket:
+    """token bucket that never sleeps: acquire() answers right away if a request can be sent.
+
+    the bucket holds up to capacity tokens and gets capacity tokens back every period seconds,
+    every request takes one. When the server tells how many requests are really left (for
+    example in response headers) sync() replaces the local estimate with it, and an empty
+    server bucket blocks every request until it's reset.
+    """
+
+    def __init__(self, capacity, period):
+        """
+        Args:
+          capacity: maximum number of requests in a burst
+          period: seconds needed to refill an empty bucket
+        """
+        self.period = period
+        self.lock = Lock()
+        self.state = {'tokens': float(capacity), 'capacity': float(capacity), 'updated': time.time(), 'blocked_until': 0.0}
+
+    def _update(self, change):
+        """applies change to the bucket state, atomically."""
+        with self.lock:
+            return change(self.state)
+
+    def _refill(self, state, now):
+        if state['blocked_until'] and now >= state['blocked_until']:
+            # the server bucket has been reset to full
+            state['tokens'] = state['capacity']
+            state['blocked_until'] = 0.0
+        rate = state['capacity'] / self.period
+        state['tokens'] = min(state['capacity'], state['tokens'] + (now - state['updated']) * rate)
+        state['updated'] = now
+
+    def acquire(self):
+        """takes a token if one is available.
+
+        Returns: True if the request can be sent, False if it would exceed the rate limit
+
+        """
+        def take(state):
+            now = time.time()
+            if now < state['blocked_until']:
+                return False
+            self._refill(state, now)
+            if state['tokens'] < 1:
+                return False
+            state['tokens'] -= 1
+            return True
+        return self._update(take)
+
+    def sync(self, limit, remaining, reset):
+        """aligns the bucket with the limits reported by the server.
+
+        Args:
+          limit: size of the server bucket, None if unknown
+          remaining: requests left in the server bucket
+          reset: epoch seconds when the server bucket will be full again
+
+        """
+        def align(state):
+            now = time.time()
+            self._refill(state, now)
+            if limit:
+                state['capacity'] = float(limit)
+            state['tokens'] = min(float(remaining), state['capacity'])
+            if remaining <= 0:
+                state['blocked_until'] = max(state['blocked_until'], reset)
+                logging.warning("rate limit exhausted, no requests until %s" % time.ctime(reset))
+        self._update(align)
+
+    def retry_after(self):
+        """returns the seconds until the next token is available."""
+        def wait(state):
+            now = time.time()
+            self._refill(state, now)
+            if state['blocked_until']:
+                return state['blocked_until'] - now
+            return max(0, 1 - state['tokens']) * self.period / state['capacity']
+        return self._update(wait)
+
+
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket stored in a SQLite database so that every process using the same file
+    and name takes its tokens from the same bucket."""
+
+    def __init__(self, path, name, capacity, period):
+        """
+        Args:
+          path: the SQLite database file, created if missing
+          name: name of the bucket, more buckets can be stored in the same file
+          capacity: maximum number of requests in a burst
+          period: seconds needed to refill an empty bucket
+        """
+        super().__init__(capacity, period)
+        self.path = path
+        self.name = name
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._connection()
+        conn.execute("CREATE TABLE IF NOT EXISTS token_bucket ("
+                     "name TEXT PRIMARY KEY, tokens REAL NOT NULL, capacity REAL NOT NULL, "
+                     "updated REAL NOT NULL, blocked_until REAL NOT NULL)")
+        conn.execute("INSERT OR IGNORE INTO token_bucket (name, tokens, capacity, updated, blocked_until) "
+                     "VALUES (?, ?, ?, ?, ?)", (name, self.state['tokens'], self.state['capacity'],
+                                                self.state['updated'], self.state['blocked_until']))
+
+    def _connection(self):
+        """returns the SQLite connection of the calling thread, sqlite3 connections can't be shared."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            # switching to WAL ignores the timeout when the workers start together on a new file
+            for _ in range(50):
+                try:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    break
+                except sqlite3.OperationalError:
+                    time.sleep(0.1)
+            self._local.conn = conn
+        return conn
+
+    def _update(self, change):
+        conn = self._connection()
+        # the write lock is taken before reading, so two workers can't spend the same token
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, capacity, updated, blocked_until FROM token_bucket WHERE name = ?",
+                               (self.name,)).fetchone()
+            state = dict(zip(('tokens', 'capacity', 'updated', 'blocked_until'), row))
+            result = change(state)
+            conn.execute("UPDATE token_bucket SET tokens = ?, capacity = ?, updated = ?, blocked_until = ? WHERE name = ?",
+                         (state['tokens'], state['capacity'], state['updated'], state['blocked_until'], self.name))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
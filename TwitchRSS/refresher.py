@@ -0,0 +1,214 @@
+"""
+File: refresher.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: background scheduler that refreshes the cached data of the most requested channels before it expires
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# seconds between two checks for channels that need a refresh
+TICK = 5
+# a request counts half after this many seconds when computing the priority of a channel
+SCORE_HALF_LIFE = 60 * 60
+
+
+class BackgroundRefresher:
+    """keeps the cache of recently requested keys warm.
+
+    every key passed to hit() is refreshed by calling refresh(key, options) a bit before
+    its cache entry expires, clients keep getting the old entry while the new one is fetched.
+    When there are more keys due than workers the most requested ones go first.
+    With leases, a key refreshed by another process sharing them is skipped until its lease ends.
+    With prepare, what the due keys have in common is fetched for all of them at once before their refreshes.
+    """
+
+    def __init__(self, refresh, lifetime, margin, workers, watch_window, leases=None, prepare=None):
+        """
+        Args:
+          refresh: function called as refresh(key, options, prepared) to refresh the cache of a key,
+                   prepared is what prepare returned for the key or None
+          lifetime: seconds the refreshed cache entries are valid for
+          margin: how many seconds before the expiration the refresh starts
+          workers: maximum number of concurrent refreshes
+          watch_window: keys not requested for this many seconds are not refreshed anymore
+          leases: optional SharedLeases of the processes sharing the cache, only one of them refreshes a key
+          prepare: optional function called as prepare(keys) with every key due, returning a dict {key: prepared},
+                   so a single request serves all of them instead of one per refresh
+        """
+        self.refresh = refresh
+        self.leases = leases
+        self.prepare = prepare
+        self.lifetime = lifetime
+        self.margin = margin
+        self.workers = workers
+        self.watch_window = watch_window
+        self.watched = {}
+        self.lock = Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='refresher')
+        self.thread = None
+
+    def hit(self, key, option=None):
+        """records a client request for key.
+
+        Args:
+          key: the key that was requested
+          option: hashable value passed back to refresh() in the options set, for example the feed settings
+
+        """
+        now = time.time()
+        with self.lock:
+            state = self.watched.get(key)
+            if state is None:
+                # the request that created the cache entry just happened
+                state = self.watched[key] = {'score': 0, 'last_hit': now, 'next_refresh': now + self.lifetime - self.margin,
+                                             'running': False, 'options': set()}
+            state['score'] = state['score'] * 0.5 ** ((now - state['last_hit']) / SCORE_HALF_LIFE) + 1
+            state['last_hit'] = now
+            if option is not None:
+                state['options'].add(option)
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name='refresher-scheduler', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(TICK)
+            try:
+                self._schedule()
+            except Exception as e:
+                logging.error("background refresher error: %s" % e)
+
+    def _schedule(self):
+        now = time.time()
+        with self.lock:
+            for key in [k for k, state in self.watched.items()
+                        if state['last_hit'] + self.watch_window < now and not state['running']]:
+                logging.debug("stopped refreshing %s, no recent requests" % key)
+                del self.watched[key]
+            running = sum(1 for state in self.watched.values() if state['running'])
+            due = [k for k, state in self.watched.items() if state['next_refresh'] <= now and not state['running']]
+            due.sort(key=lambda k: self.watched[k]['score'], reverse=True)
+            # only fill the free workers so a later tick can still pick the most requested keys first
+            picked = {}
+            for key in due[:max(self.workers - running, 0)]:
+                state = self.watched[key]
+                state['running'] = True
+                picked[key] = frozenset(state['options'])
+        if not picked:
+            return
+        prepared = {}
+        if self.prepare:
+            # the keys left for a later tick are prepared too, it's the same request
+            try:
+                prepared = self.prepare(due)
+            except Exception as e:
+                logging.warning("could not prepare the refreshes, refreshing one by one: %s" % e)
+        for key, options in picked.items():
+            self.pool.submit(self._refresh, key, options, prepared.get(key))
+
+    def _refresh(self, key, options, prepared):
+        start = time.time()
+        next_refresh = start + self.lifetime - self.margin
+        leased = False
+        try:
+            if self.leases:
+                held_until = self.leases.acquire(key, self.lifetime - self.margin)
+                if held_until is not None:
+                    logging.debug("%s is refreshed by another worker" % key)
+                    next_refresh = held_until
+                    return
+                leased = True
+            self.refresh(key, options, prepared)
+            logging.debug("refreshed %s in %.2fs" % (key, time.time() - start))
+        except Exception as e:
+            logging.warning("could not refresh %s: %s" % (key, e))
+            if leased:
+                # another worker can try right away
+                self.leases.release(key)
+        finally:
+            with self.lock:
+                state = self.watched.get(key)
+                if state is not None:
+                    state['running'] = False
+                    state['next_refresh'] = next_refresh
+
+
+class SharedLeases:
+    """time limited leases stored in a SQLite database, a key leased by one of the processes
+    sharing the file can't be leased by the others until the lease ends."""
+
+    def __init__(self, path, name):
+        """
+        Args:
+          path: the SQLite database file, created if missing
+          name: name that separates these leases from the others stored in the same file
+        """
+        self.path = path
+        self.name = name
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection().execute("CREATE TABLE IF NOT EXISTS lease ("
+                                   "name TEXT NOT NULL, key TEXT NOT NULL, until REAL NOT NULL, PRIMARY KEY (name, key))")
+
+    def _connection(self):
+        """returns the SQLite connection of the calling thread, sqlite3 connections can't be shared."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            # switching to WAL ignores the timeout when the workers start together on a new file
+            for _ in range(50):
+                try:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    break
+                except sqlite3.OperationalError:
+                    time.sleep(0.1)
+            self._local.conn = conn
+        return conn
+
+    def acquire(self, key, duration):
+        """takes the lease of key for duration seconds, unless another process holds it.
+
+        Returns: None if the lease was taken, otherwise the time the current lease ends
+
+        """
+        conn = self._connection()
+        now = time.time()
+        # the write lock is taken before reading, so two processes can't take the same lease
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT until FROM lease WHERE name = ? AND key = ?", (self.name, key)).fetchone()
+            if row is not None and row[0] > now:
+                conn.execute("ROLLBACK")
+                return row[0]
+            conn.execute("INSERT OR REPLACE INTO lease (name, key, until) VALUES (?, ?, ?)", (self.name, key, now + duration))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return None
+
+    def release(self, key):
+        """ends the lease of key before its time."""
+        self._connection().execute("DELETE FROM lease WHERE name = ? AND key = ?", (self.name, key))
@@ -0,0 +1,176 @@
+"""
+File: rss_writer.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: writes the podcast RSS as a stream of text chunks, the same XML feedgen makes without building a tree
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import datetime
+import re
+import zlib
+
+ITUNES_NS = 'http://www.itunes.com/dtds/podcast-1.0.dtd'
+XML_DECLARATION = "<?xml version='1.0' encoding='UTF-8'?>\n"
+RSS_OPEN = ('<rss xmlns:itunes="' + ITUNES_NS + '" xmlns:atom="http://www.w3.org/2005/Atom" '
+            'xmlns:content="http://purl.org/rss/1.0/modules/content/" version="2.0"><channel>')
+RSS_CLOSE = '</channel></rss>'
+# written by feedgen in every feed, kept to produce the same output
+FEEDGEN_DOCS = 'http://www.rssboard.org/rss-specification'
+FEEDGEN_GENERATOR = 'python-feedgen'
+# RFC 2822 names, independent from the locale
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+# characters lxml refuses in XML text, they are dropped instead of failing the whole feed
+INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+DURATION_SEPARATORS = re.compile('[hm]')
+# format of the helix timestamps, strings in this format sort like the dates they represent
+HELIX_TIMESTAMP = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ$')
+
+
+def escape_text(text):
+    """escapes text for the content of an element."""
+    # chained replaces are several times faster than str.translate
+    text = INVALID_XML_CHARS.sub('', text).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return text.replace('\r', '&#13;') if '\r' in text else text
+
+
+def escape_attribute(text):
+    """escapes text for the value of a double quoted attribute."""
+    text = INVALID_XML_CHARS.sub('', text).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return text.replace('"', '&quot;').replace('\t', '&#9;').replace('\n', '&#10;').replace('\r', '&#13;')
+
+
+def element(name, text):
+    """returns the element with the given text, nothing if the text is empty like feedgen does."""
+    if not text:
+        return ''
+    return '<%s>%s</%s>' % (name, escape_text(text), name)
+
+
+def format_rfc2822(date):
+    """formats an aware datetime like feedgen, for example 'Wed, 03 Mar 2021 12:00:00 +0000'."""
+    offset = int(date.utcoffset().total_seconds()) // 60
+    return '%s, %02d %s %04d %02d:%02d:%02d %s%02d%02d' % (
+        WEEKDAYS[date.weekday()], date.day, MONTHS[date.month - 1], date.year, date.hour, date.minute, date.second,
+        '-' if offset < 0 else '+', abs(offset) // 60, abs(offset) % 60)
+
+
+def parse_helix_timestamp(timestamp):
+    """parses a helix timestamp like '2021-03-03T12:00:00Z' into an aware UTC datetime."""
+    return datetime.datetime.fromisoformat(timestamp[:-1]).replace(tzinfo=datetime.timezone.utc)
+
+
+def format_duration(duration):
+    """converts a helix duration like '1h2m3s' into the itunes format '01:02:03'."""
+    parts = DURATION_SEPARATORS.sub(':', duration).replace('s', '').split(':')
+    return ':'.join(['%02d' % int(part) for part in parts])
+
+
+def format_seconds(seconds):
+    """converts a duration in seconds into the itunes format '01:02:03'."""
+    seconds = int(seconds)
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def channel(title, link, description, image, itunes_author, itunes_image, itunes_explicit, itunes_complete,
+            itunes_summary, last_build_date=None):
+    """returns the start of the feed, up to the first item.
+
+    Args:
+      title: title of the feed
+      link: link of the channel, also used as the atom self link
+      description: description of the feed
+      image: url of the feed image
+      itunes_author: the itunes:author
+      itunes_image: the itunes:image, ignored if it's not a .jpg or .png like feedgen does
+      itunes_explicit: 'yes', 'no' or 'clean'
+      itunes_complete: True if the podcast won't have new episodes
+      itunes_summary: the itunes:summary
+      last_build_date: aware datetime of the lastBuildDate, now if None
+
+    Returns: the text of the feed start
+
+    """
+    if last_build_date is None:
+        last_build_date = datetime.datetime.now(datetime.timezone.utc)
+    chunk = [XML_DECLARATION, RSS_OPEN,
+             element('title', title), element('link', link), element('description', description),
+             '<atom:link href="%s" rel="self"/>' % escape_attribute(link),
+             element('docs', FEEDGEN_DOCS), element('generator', FEEDGEN_GENERATOR),
+             '<image>', element('url', image), element('title', title), element('link', link), '</image>',
+             element('lastBuildDate', format_rfc2822(last_build_date)),
+             element('itunes:author', itunes_author)]
+    if itunes_image and (itunes_image.endswith('.jpg') or itunes_image.endswith('.png')):
+        chunk.append('<itunes:image href="%s"/>' % escape_attribute(itunes_image))
+    chunk.append(element('itunes:explicit', itunes_explicit))
+    chunk.append(element('itunes:complete', 'yes' if itunes_complete else 'no'))
+    chunk.append(element('itunes:summary', itunes_summary))
+    return ''.join(chunk)
+
+
+def item(title, description, guid, pub_date, enclosure_url=None, enclosure_type=None, enclosure_length=0,
+         itunes_author=None, itunes_image=None, itunes_duration=None):
+    """returns one item of the feed.
+
+    Args:
+      title: title of the episode
+      description: description of the episode, html is escaped
+      guid: unique id of the episode, not a permalink
+      pub_date: aware datetime of the publication
+      enclosure_url: url of the audio, no enclosure if None
+      enclosure_type: mimetype of the audio
+      enclosure_length: size of the audio in bytes, 0 if unknown
+      itunes_author: the itunes:author
+      itunes_image: the itunes:image, must be a .jpg or .png
+      itunes_duration: the itunes:duration, like '01:02:03'
+
+    Returns: the text of the item
+
+    """
+    chunk = ['<item>', element('title', title), element('description', description)]
+    if guid:
+        chunk.append('<guid isPermaLink="false">%s</guid>' % escape_text(guid))
+    if enclosure_url:
+        chunk.append('<enclosure url="%s" length="%d" type="%s"/>' % (escape_attribute(enclosure_url), enclosure_length,
+                                                                      escape_attribute(enclosure_type)))
+    chunk.append(element('pubDate', format_rfc2822(pub_date)))
+    chunk.append(element('itunes:author', itunes_author))
+    if itunes_image:
+        chunk.append('<itunes:image href="%s"/>' % escape_attribute(itunes_image))
+    chunk.append(element('itunes:duration', itunes_duration))
+    chunk.append('</item>')
+    return ''.join(chunk)
+
+
+def close():
+    """returns the end of the feed."""
+    return RSS_CLOSE
+
+
+def encode(chunks):
+    """encodes the text chunks of the feed, returns the UTF-8 and the gzip bytes
+    of the whole feed, both made in a single pass over the chunks."""
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    raw = []
+    compressed = []
+    for chunk in chunks:
+        data = chunk.encode('utf-8')
+        raw.append(data)
+        compressed.append(compressor.compress(data))
+    compressed.append(compressor.flush())
+    return b''.join(raw), b''.join(compressed)
@@ -0,0 +1,103 @@
+"""
+File: single_flight.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: caching decorator that runs a single computation for concurrent misses of the same key
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from concurrent.futures import Future
+from functools import wraps
+from threading import Lock
+
+from cachetools import keys
+
+counters = {}
+counters_lock = Lock()
+
+
+def _count(name, event):
+    with counters_lock:
+        counter = counters.setdefault(name, {'hits': 0, 'misses': 0, 'coalesced': 0})
+        counter[event] += 1
+
+
+def cache_stats():
+    """returns a copy of the counters of every cached function: hits, misses (computations)
+    and coalesced (calls that waited for the computation started by another thread)."""
+    with counters_lock:
+        return {name: dict(counter) for name, counter in counters.items()}
+
+
+def cached(cache, lock, key=keys.hashkey, name=None):
+    """drop-in replacement of cachetools.cached that also coalesces concurrent misses.
+
+    the first thread missing a key computes the value, the other threads asking for the
+    same key in the meantime wait for it and get the same value (or the same exception)
+    instead of computing it again. Only the threads of one process are coalesced.
+
+    Args:
+      cache: the cache, any mutable mapping like cachetools.TTLCache
+      lock: lock held while the cache is accessed, never while the value is computed
+      key: function returning the cache key of the arguments
+      name: name of the counters in cache_stats(), the function name if None
+
+    """
+    def decorator(func):
+        counter_name = name or func.__name__
+        in_flight = {}
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            k = key(*args, **kwargs)
+            with lock:
+                try:
+                    value = cache[k]
+                except KeyError:
+                    pass
+                else:
+                    _count(counter_name, 'hits')
+                    return value
+                future = in_flight.get(k)
+                leader = future is None
+                if leader:
+                    future = in_flight[k] = Future()
+
+            if not leader:
+                _count(counter_name, 'coalesced')
+                return future.result()
+
+            _count(counter_name, 'misses')
+            try:
+                value = func(*args, **kwargs)
+            except BaseException as e:
+                with lock:
+                    del in_flight[k]
+                future.set_exception(e)
+                raise
+            with lock:
+                try:
+                    cache[k] = value
+                except ValueError:
+                    # value too large for the cache
+                    pass
+                del in_flight[k]
+            future.set_result(value)
+            return value
+
+        return wrapper
+    return decorator
@@ -0,0 +1,253 @@
+"""
+File: transcode_cache.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: on-disk cache of transcoded vods, one ffmpeg run is shared by every listener of the same vod
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from threading import Lock, Thread
+import asyncio
+import logging
+import os
+import subprocess
+import time
+
+PARTIAL_SUFFIX = '.part'
+# seconds to wait for the writer before checking the partial file again
+TAIL_POLL_INTERVAL = 0.25
+CHUNK_SIZE = 64 * 1024
+
+
+class TranscodeFailedException(Exception):
+    """raised to the listeners when the ffmpeg run writing the file fails or stalls."""
+    pass
+
+
+class TranscodeCache:
+    """directory of transcoded files shared by all the listeners and all the gunicorn workers.
+
+    the first request of a file starts ffmpeg writing to "<name>.part", the following ones
+    read the bytes already written and follow the file while it grows (like tail -f).
+    Once ffmpeg is done the file is renamed to "<name>" and served straight from disk,
+    the least recently served complete files are deleted when the cache grows over max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes, stall_timeout=60):
+        """
+        Args:
+          directory: where the files are stored, created if missing
+          max_bytes: the complete files are evicted when their total size exceeds this
+          stall_timeout: seconds without writes after which a partial file is considered abandoned
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stall_timeout = stall_timeout
+        self.writers = {}
+        self.lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        """returns the path of the complete file with the given name."""
+        return os.path.join(self.directory, name)
+
+    def complete_path(self, name):
+        """returns the path of the complete file if it exists and marks it as recently used, None otherwise."""
+        path = self.path(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def written_bytes(self, name):
+        """returns how many bytes of the file are available right now (complete or partial)."""
+        for path in (self.path(name), self.path(name) + PARTIAL_SUFFIX):
+            try:
+                return os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        return 0
+
+    def needs_writer(self, name):
+        """returns True if nobody has written or is writing the file, so start() would run ffmpeg."""
+        if self.complete_path(name):
+            return False
+        with self.lock:
+            if name in self.writers:
+                return False
+        try:
+            return time.time() - os.path.getmtime(self.path(name) + PARTIAL_SUFFIX) > self.stall_timeout
+        except FileNotFoundError:
+            return True
+
+    def start(self, name, command, finalize=None, on_exit=None):
+        """starts the ffmpeg command writing to the partial file, unless a complete or
+        partial file already exists or another process is writing it.
+
+        Args:
+          name: the file name inside the cache directory
+          command: the ffmpeg command writing the output to stdout
+          finalize: optional function called with the path of the partial file once ffmpeg is done, before it's renamed,
+                    it can raise TranscodeFailedException to discard the file
+          on_exit: optional function called with the ffmpeg process once it exits
+
+        Returns: the ffmpeg process if a new run was started, None otherwise
+
+        """
+        if self.complete_path(name):
+            return None
+        partial = self.path(name) + PARTIAL_SUFFIX
+        with self.lock:
+            if name in self.writers:
+                return None
+            try:
+                if time.time() - os.path.getmtime(partial) > self.stall_timeout:
+                    logging.warning("removing abandoned partial transcode: " + partial)
+                    os.remove(partial)
+            except FileNotFoundError:
+                pass
+            try:
+                fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                # another worker is writing it
+                return None
+            with os.fdopen(fd, 'wb') as output:
+                try:
+                    process = subprocess.Popen(command, stdout=output, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+                except Exception:
+                    # an empty partial file would make the other listeners wait for a writer that never started
+                    os.remove(partial)
+                    raise
+            self.writers[name] = process
+        logging.info("started cached transcode: " + name)
+        Thread(target=self._wait_writer, args=(name, process, finalize, on_exit), name='transcode-writer', daemon=True).start()
+        return process
+
+    def _wait_writer(self, name, process, finalize, on_exit):
+        _, errors = process.communicate()
+        partial = self.path(name) + PARTIAL_SUFFIX
+        try:
+            if process.returncode == 0:
+                if finalize:
+                    finalize(partial)
+                os.replace(partial, self.path(name))
+                logging.info("cached transcode completed: " + name)
+            else:
+                logging.error("ffmpeg error while writing cached transcode " + name)
+                logging.error(errors)
+                os.remove(partial)
+        except TranscodeFailedException as e:
+            logging.error(e)
+            os.remove(partial)
+        except FileNotFoundError:
+            pass
+        finally:
+            with self.lock:
+                self.writers.pop(name, None)
+            if on_exit:
+                on_exit(process)
+        self.evict()
+
+    def tail(self, name, offset=0, length=None):
+        """yields the content of the file starting from offset, waiting for the writer
+        to produce the missing bytes if the file is still partial.
+
+        Args:
+          name: the file name inside the cache directory
+          offset: the first byte to send
+          length: how many bytes to send, until the end of the file if None
+
+        """
+        for data in self._tail_steps(name, offset, length):
+            if data is None:
+                time.sleep(TAIL_POLL_INTERVAL)
+            else:
+                yield data
+
+    async def atail(self, name, offset=0, length=None):
+        """async version of tail(), waiting for the writer doesn't block the event loop."""
+        steps = self._tail_steps(name, offset, length)
+        try:
+            for data in steps:
+                if data is None:
+                    await asyncio.sleep(TAIL_POLL_INTERVAL)
+                else:
+                    yield data
+        finally:
+            steps.close()
+
+    def _tail_steps(self, name, offset, length):
+        """yields the chunks of the file, or None when the caller has to wait for the writer."""
+        path = self.path(name)
+        partial = path + PARTIAL_SUFFIX
+        try:
+            source = open(path, 'rb')
+            complete = True
+        except FileNotFoundError:
+            try:
+                source = open(partial, 'rb')
+            except FileNotFoundError:
+                # the writer finished between the two open calls, or failed and removed the partial file
+                try:
+                    source = open(path, 'rb')
+                except FileNotFoundError:
+                    raise TranscodeFailedException("the transcode of %s failed" % name)
+            complete = False
+
+        with source:
+            source.seek(offset)
+            last_data = time.time()
+            remaining = length
+            while remaining is None or remaining > 0:
+                data = source.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+                if data:
+                    last_data = time.time()
+                    if remaining is not None:
+                        remaining -= len(data)
+                    yield data
+                    continue
+                if complete:
+                    return
+                # the open file keeps pointing to the same data after the rename, so one more
+                # read after the complete file shows up is enough to get the last bytes
+                if os.path.exists(path):
+                    complete = True
+                    continue
+                if not os.path.exists(partial):
+                    raise TranscodeFailedException("the transcode of %s failed" % name)
+                if time.time() - last_data > self.stall_timeout:
+                    raise TranscodeFailedException("the transcode of %s stalled" % name)
+                yield None
+
+    def evict(self):
+        """deletes the least recently served complete files until the cache fits in max_bytes."""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(PARTIAL_SUFFIX):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            logging.info("evicting cached transcode: " + path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
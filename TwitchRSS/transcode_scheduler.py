@@ -0,0 +1,159 @@
+"""
+File: transcode_scheduler.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: limits how many ffmpeg processes run at once and decides who goes next
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from itertools import count
+from threading import Condition, Thread
+import logging
+import time
+
+# seconds between two checks for idle transcodes
+REAP_INTERVAL = 60
+
+
+class QueueFullException(Exception):
+    """raised when a transcode can't be admitted, the client should retry later."""
+    pass
+
+
+class TranscodeScheduler:
+    """admission control for the ffmpeg processes.
+
+    at most max_running transcodes hold a slot at the same time, the others wait in a queue
+    of at most max_queued requests. When a slot frees up seeks go before full downloads
+    (someone is listening and waiting), then the clients with the fewest running transcodes,
+    then the oldest request. A background thread kills the transcodes nobody reads anymore.
+    """
+
+    def __init__(self, max_running, max_queued, queue_timeout, idle_timeout):
+        """
+        Args:
+          max_running: maximum number of concurrent transcodes
+          max_queued: maximum number of requests waiting for a slot
+          queue_timeout: seconds a request waits for a slot before giving up
+          idle_timeout: seconds of inactivity after which a transcode is killed
+        """
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.idle_timeout = idle_timeout
+        self.running = []
+        self.waiting = []
+        self.sequence = count()
+        self.cond = Condition()
+        self.reaper = None
+
+    def _running_for(self, client_id):
+        return sum(1 for slot in self.running if slot['client'] == client_id)
+
+    def _next_waiter(self):
+        return min(self.waiting, key=lambda w: (not w['seek'], self._running_for(w['client']), w['seq']))
+
+    def acquire(self, key, client_id, seek=False, reapable=True):
+        """waits for a free slot.
+
+        Args:
+          key: id of the transcode, the same key can be killed with kill()
+          client_id: id of the client, slots are shared fairly between clients
+          seek: True if the client is seeking, seeks have priority over full downloads
+          reapable: False for transcodes that must not be killed when nobody reads them
+
+        Returns: the slot, to be passed to the other methods
+        Raises: QueueFullException if the queue is full or the wait timed out
+
+        """
+        with self.cond:
+            if self.reaper is None:
+                self.reaper = Thread(target=self._reap, name='transcode-reaper', daemon=True)
+                self.reaper.start()
+            if len(self.running) >= self.max_running or self.waiting:
+                if len(self.waiting) >= self.max_queued:
+                    raise QueueFullException("transcode queue is full")
+                waiter = {'seq': next(self.sequence), 'client': client_id, 'seek': seek}
+                self.waiting.append(waiter)
+                deadline = time.time() + self.queue_timeout
+                try:
+                    while len(self.running) >= self.max_running or self._next_waiter() is not waiter:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise QueueFullException("timed out waiting for a transcode slot")
+                        self.cond.wait(remaining)
+                finally:
+                    self.waiting.remove(waiter)
+                    self.cond.notify_all()
+            slot = {'key': key, 'client': client_id, 'process': None, 'last_active': time.time(), 'reapable': reapable}
+            self.running.append(slot)
+        logging.debug("transcode slot assigned to %s (%d running, %d waiting)" % (key, len(self.running), len(self.waiting)))
+        return slot
+
+    def attach(self, slot, process):
+        """associates the ffmpeg process to the slot, so it can be killed."""
+        slot['process'] = process
+        slot['last_active'] = time.time()
+
+    def touch(self, slot):
+        """marks the transcode as active."""
+        slot['last_active'] = time.time()
+
+    def release(self, slot, kill=False):
+        """frees the slot, nothing happens if it was already released.
+
+        Args:
+          slot: the slot returned by acquire()
+          kill: True to also kill its ffmpeg process
+
+        """
+        with self.cond:
+            # compared by identity, two slots can hold the same values
+            if any(running is slot for running in self.running):
+                self.running = [running for running in self.running if running is not slot]
+                self.cond.notify_all()
+        if kill and slot['process'] is not None:
+            logging.debug("killing transcoding process: " + str(slot['key']))
+            slot['process'].kill()
+
+    def kill(self, key):
+        """kills and frees every transcode with the given key."""
+        with self.cond:
+            slots = [slot for slot in self.running if slot['key'] == key]
+        for slot in slots:
+            self.release(slot, kill=True)
+
+    def active(self):
+        """returns the keys of the transcodes holding a slot."""
+        with self.cond:
+            return [slot['key'] for slot in self.running]
+
+    def queued(self):
+        """returns how many requests are waiting for a slot."""
+        with self.cond:
+            return len(self.waiting)
+
+    def _reap(self):
+        while True:
+            time.sleep(REAP_INTERVAL)
+            now = time.time()
+            with self.cond:
+                stalled = [slot for slot in self.running
+                           if slot['reapable'] and slot['last_active'] + self.idle_timeout < now]
+            for slot in stalled:
+                logging.info("killing stalled transcode with id: " + str(slot['key']))
+                self.release(slot, kill=True)
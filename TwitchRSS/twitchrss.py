@@ -22,57 +22,198 @@ Description: webserver that converts a twitch channel into a podcast feed
 #
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 from html import escape as html_escape
 from os import environ
-from threading import Lock, RLock
-from dateutil.parser import parse as parse_date
+from threading import Lock, Thread
+from urllib.parse import quote, urlencode
+import asyncio
 import subprocess
 import datetime
-import gzip
+import os
+import hashlib
 import json
 import logging
 import re
+import tempfile
 import time
-import urllib
 import random
-
-import pytz
-import m3u8
-from cachetools import cached, TTLCache
-from feedgen.feed import FeedGenerator
-from flask import abort, Flask, request, render_template, stream_with_context, Response, url_for
-from git import Repo
-from ratelimit import limits, sleep_and_retry
-from streamlink import Streamlink
-from streamlink.exceptions import PluginError
+import math
+
+from cachetools import keys, TTLCache
+from flask import abort, Flask, g, request, render_template, send_file, stream_with_context, Response, url_for
+from batcher import RequestBatcher
+from persistent_cache import PersistentTTLCache
+from rate_limit import RateLimitedException, SharedTokenBucket, TokenBucket
+from single_flight import cache_stats, cached
+from refresher import BackgroundRefresher, SharedLeases
+from pretranscoder import Pretranscoder
+import metrics
+import rss_writer
+from http_client import HttpClient, HttpRequestException
+from hls_proxy import HlsProxy, SegmentFetchException
+from mp3_index import Mp3Layout, PlaylistIndex
+from transcode_cache import TranscodeCache, TranscodeFailedException
+from transcode_scheduler import QueueFullException, TranscodeScheduler
 
 app = Flask(__name__)
 
-VOD_URL_TEMPLATE = 'https://api.twitch.tv/helix/videos?sort=time&user_id=%s&type=all'
-USERID_URL_TEMPLATE = 'https://api.twitch.tv/helix/users?login=%s'
-STREAMS_URL_TEMPLATE = 'https://api.twitch.tv/helix/streams?user_id=%s'
+TWITCH_API_URL = 'https://api.twitch.tv/helix/'
+TWITCH_AUTH_URL = 'https://id.twitch.tv/oauth2/token'
 VODCACHE_LIFETIME = 10 * 60
 USERIDCACHE_LIFETIME = 24 * 60 * 60
 VODURLSCACHE_LIFETIME = 24 * 60 * 60
+# playlists of vods still being recorded keep growing, they're downloaded again after this
+LIVE_PLAYLIST_LIFETIME = 60
+FEEDCACHE_LIFETIME = 60 * 60
+STALECACHE_LIFETIME = 7 * 24 * 60 * 60
+VODINDEX_LIFETIME = 30 * 24 * 60 * 60
+NOAUDIO_RETRY_DELAY = 10 * 60
+NOAUDIO_MAX_RETRY_DELAY = 6 * 60 * 60
 CHECK_UPDATE_INTERVAL = 24 * 60 * 60
+REFRESH_MARGIN = 60
+REFRESH_WATCH_WINDOW = 24 * 60 * 60
 CHANNEL_FILTER = re.compile("^[a-zA-Z0-9_]{2,25}$")
+AUDIO_MIMETYPES = {
+    'mp3': 'audio/mpeg',
+    'aac': 'audio/aac',
+    'm4a': 'audio/mp4',
+    'ts': 'video/mp2t',
+}
+# ffmpeg output options of the formats that only copy the aac audio of the vod in a new container
+REMUX_FORMATS = {
+    'aac': ["-f", "adts"],
+    'm4a': ["-bsf:a", "aac_adtstoasc", "-f", "mp4", "-movflags", "frag_keyframe+empty_moov+default_base_moof"],
+}
 TWITCH_CLIENT_ID = environ.get("TWITCH_CLIENT_ID")
 TWITCH_SECRET = environ.get("TWITCH_SECRET")
 TWITCH_OAUTH_TOKEN = ""
 TWITCH_OAUTH_EXPIRE_EPOCH = 0
 GITHUB_REPO = 'madiele/TwitchToPodcastRSS'
+AUDIO_ERROR_MESSAGE = "TwitchToPodcastRSS ERROR: could not fetch an audio stream for this vod,"
 TRANSCODE = False
 TRANSCODE_BITRATE = 128000
 TRANSCODE_SECONDS_BUFFER = 120
 TRANSCODE_BANDWITH_kbps = 500
+TRANSCODE_SAMPLE_RATE = 48000
+# mp3 settings a feed can pick with ?profile=name, as (bitrate, sample rate, channels)
+TRANSCODE_PROFILES = {
+    'low': (48000, 24000, 1),
+    'high': (192000, 48000, 2),
+}
+# the profile of the feeds without ?profile=, made from TRANSCODE_BITRATE
+DEFAULT_TRANSCODE_PROFILE = 'default'
+TRANSCODE_FORMAT = 'mp3'
+STREAMLINK_WORKERS = 4
+HLS_PROXY_CONNECTIONS = 16
+HLS_PROXY_PREFETCH = 4
+TWITCH_API_CONNECTIONS = 10
+TWITCH_RATE_LIMIT = 800
+FULL_VOD_HISTORY = False
+VOD_HISTORY_RESYNC = 24 * 60 * 60
+VOD_HISTORY_MAX_PAGES = 50
+# helix endpoints whose lookups are batched, with the parameter (and response field) they are looked up by
+HELIX_BATCH_FIELDS = {
+    'users': 'login',
+    'streams': 'user_id',
+}
+CACHE_DB = None
+BACKGROUND_REFRESH = False
+TRANSCODE_CACHE_DIR = None
+TRANSCODE_CACHE_MAX_MB = 2048
+TRANSCODE_MAX_CONCURRENT = os.cpu_count() or 1
+TRANSCODE_MAX_QUEUE = 20
+TRANSCODE_QUEUE_TIMEOUT = 5
+# threads answering the requests of a worker: the gunicorn --threads, or ASGI_THREADS in asgi mode
+REQUEST_THREADS = 5
+TRANSCODE_IDLE_TIMEOUT = 10 * 60
+# bytes read from ffmpeg at once, and seconds between two updates of the transcode activity
+TRANSCODE_CHUNK_SIZE = 64 * 1024
+TRANSCODE_ACTIVITY_INTERVAL = 5
+# the most silence added to a transcode that came out shorter than its Content-Length, as a fraction of its
+# length and at least TRANSCODE_MIN_PADDING_FRAMES: the durations of the playlist and of the ffmpeg output differ
+# by a rounding that grows with the vod, a bigger gap means ffmpeg stopped early and the client has to see a short read to retry
+TRANSCODE_MAX_PADDING = 0.002
+TRANSCODE_MIN_PADDING_FRAMES = 16
+REFRESH_WORKERS = 2
+WARM_UP = True
+PRETRANSCODE = False
+PRETRANSCODE_WORKERS = 1
+PRETRANSCODE_MAX_MB = 1024
+PRETRANSCODE_NICENESS = 19
+# only vods created in the last 2 days count as new, so a restart doesn't transcode the whole history
+PRETRANSCODE_MAX_AGE = 2 * 24 * 60 * 60
 if environ.get('TRANSCODE') and environ.get('TRANSCODE').lower() == 'true':
     TRANSCODE = True
 if environ.get('TRANSCODE_BITRATE'):
     TRANSCODE_BITRATE = int(environ.get('TRANSCODE_BITRATE'))
+if environ.get('TRANSCODE_PROFILES'):
+    # name:bitrate:sample_rate:channels separated by commas, for example low:48000:24000:1,high:192000:48000:2
+    for definition in environ.get('TRANSCODE_PROFILES').split(','):
+        name, bitrate, sample_rate, channels = definition.strip().split(':')
+        TRANSCODE_PROFILES[name.lower()] = (int(bitrate), int(sample_rate), int(channels))
+TRANSCODE_PROFILES[DEFAULT_TRANSCODE_PROFILE] = (TRANSCODE_BITRATE, TRANSCODE_SAMPLE_RATE, 2)
 if environ.get('TRANSCODE_SECONDS_BUFFER'):
     TRANSCODE_SECONDS_BUFFER = int(environ.get('TRANSCODE_SECONDS_BUFFER'))
 if environ.get('TRANSCODE_BANDWITH_kbps'):
     TRANSCODE_BANDWITH_kbps = float(environ.get('TRANSCODE_BANDWITH_kbps'))
+if environ.get('TRANSCODE_FORMAT'):
+    TRANSCODE_FORMAT = environ.get('TRANSCODE_FORMAT').lower()
+if environ.get('STREAMLINK_WORKERS'):
+    STREAMLINK_WORKERS = int(environ.get('STREAMLINK_WORKERS'))
+if environ.get('HLS_PROXY_CONNECTIONS'):
+    HLS_PROXY_CONNECTIONS = int(environ.get('HLS_PROXY_CONNECTIONS'))
+if environ.get('HLS_PROXY_PREFETCH'):
+    HLS_PROXY_PREFETCH = int(environ.get('HLS_PROXY_PREFETCH'))
+if environ.get('TWITCH_API_URL'):
+    TWITCH_API_URL = environ.get('TWITCH_API_URL').rstrip('/') + '/'
+if environ.get('TWITCH_AUTH_URL'):
+    TWITCH_AUTH_URL = environ.get('TWITCH_AUTH_URL')
+if environ.get('TWITCH_API_CONNECTIONS'):
+    TWITCH_API_CONNECTIONS = int(environ.get('TWITCH_API_CONNECTIONS'))
+if environ.get('TWITCH_RATE_LIMIT'):
+    TWITCH_RATE_LIMIT = int(environ.get('TWITCH_RATE_LIMIT'))
+if environ.get('FULL_VOD_HISTORY') and environ.get('FULL_VOD_HISTORY').lower() == 'true':
+    FULL_VOD_HISTORY = True
+if environ.get('VOD_HISTORY_RESYNC'):
+    VOD_HISTORY_RESYNC = int(environ.get('VOD_HISTORY_RESYNC'))
+if environ.get('VOD_HISTORY_MAX_PAGES'):
+    VOD_HISTORY_MAX_PAGES = int(environ.get('VOD_HISTORY_MAX_PAGES'))
+if environ.get('CACHE_DB'):
+    CACHE_DB = environ.get('CACHE_DB')
+if environ.get('BACKGROUND_REFRESH') and environ.get('BACKGROUND_REFRESH').lower() == 'true':
+    BACKGROUND_REFRESH = True
+if environ.get('REFRESH_WORKERS'):
+    REFRESH_WORKERS = int(environ.get('REFRESH_WORKERS'))
+if environ.get('WARM_UP') and environ.get('WARM_UP').lower() == 'false':
+    WARM_UP = False
+if environ.get('TRANSCODE_CACHE_DIR'):
+    TRANSCODE_CACHE_DIR = environ.get('TRANSCODE_CACHE_DIR')
+if environ.get('TRANSCODE_CACHE_MAX_MB'):
+    TRANSCODE_CACHE_MAX_MB = int(environ.get('TRANSCODE_CACHE_MAX_MB'))
+if environ.get('TRANSCODE_MAX_CONCURRENT'):
+    TRANSCODE_MAX_CONCURRENT = int(environ.get('TRANSCODE_MAX_CONCURRENT'))
+if environ.get('TRANSCODE_MAX_QUEUE'):
+    TRANSCODE_MAX_QUEUE = int(environ.get('TRANSCODE_MAX_QUEUE'))
+if environ.get('TRANSCODE_QUEUE_TIMEOUT'):
+    TRANSCODE_QUEUE_TIMEOUT = int(environ.get('TRANSCODE_QUEUE_TIMEOUT'))
+if environ.get('SERVER_MODE') == 'asgi':
+    REQUEST_THREADS = int(environ.get('ASGI_THREADS') or 16)
+elif environ.get('THREADS'):
+    REQUEST_THREADS = int(environ.get('THREADS'))
+if environ.get('PRETRANSCODE') and environ.get('PRETRANSCODE').lower() == 'true':
+    PRETRANSCODE = True
+if environ.get('PRETRANSCODE_WORKERS'):
+    PRETRANSCODE_WORKERS = int(environ.get('PRETRANSCODE_WORKERS'))
+if environ.get('PRETRANSCODE_MAX_MB'):
+    PRETRANSCODE_MAX_MB = int(environ.get('PRETRANSCODE_MAX_MB'))
+if environ.get('PRETRANSCODE_NICENESS'):
+    PRETRANSCODE_NICENESS = int(environ.get('PRETRANSCODE_NICENESS'))
+
+VOD_URL_TEMPLATE = TWITCH_API_URL + 'videos?sort=time&user_id=%s&type=all'
+VOD_PAGE_URL_TEMPLATE = VOD_URL_TEMPLATE + '&first=100'
+HELIX_BATCH_URL_TEMPLATE = TWITCH_API_URL + '%s'
 
 if environ.get('SERVER_NAME'):
     app.config['SERVER_NAME'] = environ.get('SERVER_NAME')
@@ -90,16 +231,89 @@ if not TWITCH_CLIENT_ID:
 if not TWITCH_SECRET:
     raise Exception("Twitch API secret env variable not set.")
 
-streamlink_session = Streamlink(options=None)
-streamUrl_queues = {}
+# updated by the request paths, the other metrics are collected only when /metrics is read
+request_seconds = metrics.Histogram('twitchrss_request_seconds', 'seconds until the response of a route is ready, streaming excluded', ['route'])
+responses_total = metrics.Counter('twitchrss_responses_total', 'responses by route and status code', ['route', 'code'])
+upstream_seconds = metrics.Histogram('twitchrss_upstream_request_seconds', 'seconds of every try of a twitch API request', ['endpoint'])
+streamlink_seconds = metrics.Histogram('twitchrss_streamlink_seconds', 'seconds spent by streamlink to find the audio stream of a vod')
+rate_limited_total = metrics.Counter('twitchrss_rate_limited_total', 'twitch fetches refused by the rate limit, by what was served instead', ['served'])
+feed_bytes = metrics.Histogram('twitchrss_feed_bytes', 'size of the generated feeds',
+                               buckets=(1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6))
+feed_build_seconds = metrics.Histogram('twitchrss_feed_build_seconds', 'seconds spent writing and compressing a feed')
+transcode_bytes = metrics.Counter('twitchrss_transcode_bytes_total', 'mp3 bytes produced by ffmpeg for the listeners')
+transcode_speed = metrics.Histogram('twitchrss_transcode_speed', 'seconds of audio produced per second by a transcode, 1 is realtime',
+                                    buckets=(0.5, 1, 2, 5, 10, 20, 50, 100))
+
+# created by get_streamlink_session() on first use, streamlink and its plugins are the slowest part of the startup
+streamlink_session = None
+streamlink_session_lock = Lock()
+# keep-alive connections to the twitch API, shared by all the threads of the worker
+twitch_client = HttpClient(connections=TWITCH_API_CONNECTIONS, timeout=3, retries=3,
+                           observe=lambda endpoint, seconds: upstream_seconds.observe(seconds, endpoint))
+streamlink_pool = ThreadPoolExecutor(max_workers=STREAMLINK_WORKERS, thread_name_prefix='streamlink')
 cache_locks = {
     'fetch_channel': Lock(),
     'fetch_vods': Lock(),
     'fetch_streams': Lock(),
     'get_audiostream_url': Lock(),
+    'no_audio': Lock(),
+    'feed': Lock(),
+    'stale': Lock(),
+    'vod_index': Lock(),
+    'get_playlist': Lock(),
+    'load_playlist': Lock(),
+    'playlist_duration': Lock(),
+    'short_transcode': Lock(),
     'check_for_updates': Lock(),
 }
 
+
+def make_cache(name, maxsize, ttl):
+    """creates the cache used by a cached function.
+
+    Args:
+      name: unique name of the cache
+      maxsize: maximum number of entries
+      ttl: seconds an entry is valid for
+
+    Returns: a TTLCache, or a PersistentTTLCache shared by all workers if CACHE_DB is set
+
+    """
+    if CACHE_DB:
+        return PersistentTTLCache(CACHE_DB, name, maxsize=maxsize, ttl=ttl)
+    return TTLCache(maxsize=maxsize, ttl=ttl)
+
+
+caches = {
+    'fetch_channel': make_cache('fetch_channel', 3000, USERIDCACHE_LIFETIME),
+    'fetch_vods': make_cache('fetch_vods', 500, VODCACHE_LIFETIME),
+    'fetch_streams': make_cache('fetch_streams', 500, VODCACHE_LIFETIME),
+    'get_audiostream_url': make_cache('get_audiostream_url', 3000, VODURLSCACHE_LIFETIME),
+    # vods without an audio stream, kept long enough to remember the backoff
+    'no_audio': make_cache('no_audio', 3000, VODURLSCACHE_LIFETIME),
+    # rendered feeds, rebuilt as soon as the twitch data they were made from changes
+    'feed': make_cache('feed', 500, FEEDCACHE_LIFETIME),
+    # last good twitch responses, served when the rate limit doesn't allow a new request
+    'stale': make_cache('stale', 5000, STALECACHE_LIFETIME),
+    # every vod of a channel when FULL_VOD_HISTORY is set, updated with the newest page only
+    'vod_index': make_cache('vod_index', 500, VODINDEX_LIFETIME),
+    # parsed audio playlists of the finished vods, used by the audio routes
+    'get_playlist': make_cache('get_playlist', 3000, VODURLSCACHE_LIFETIME),
+    # every parsed playlist for a short while, so the requests of a player don't download it again.
+    # Only the worker downloading them uses the unfinished ones, they're never shared through CACHE_DB
+    'load_playlist': TTLCache(maxsize=100, ttl=LIVE_PLAYLIST_LIFETIME),
+    # exact duration of the finished vods, all the feeds need from the playlists
+    'playlist_duration': make_cache('playlist_duration', 3000, VODURLSCACHE_LIFETIME),
+    # cached transcodes that already came out too short once, the next run is padded instead of discarded
+    'short_transcode': make_cache('short_transcode', 3000, VODURLSCACHE_LIFETIME),
+}
+
+# the helix budget (requests per minute), shared by all the workers if CACHE_DB is set
+if CACHE_DB:
+    twitch_rate_limit = SharedTokenBucket(CACHE_DB, 'helix', TWITCH_RATE_LIMIT, 60)
+else:
+    twitch_rate_limit = TokenBucket(TWITCH_RATE_LIMIT, 60)
+
 def authorize():
     """updates the oauth token if expired."""
 
@@ -114,23 +328,14 @@ def authorize():
         'client_secret': TWITCH_SECRET,
         'grant_type': 'client_credentials',
     }
-    url = 'https://id.twitch.tv/oauth2/token'
-    request = urllib.request.Request(url, data=urllib.parse.urlencode(data).encode("utf-8"), method='POST')
-    retries = 0
-    while retries < 3:
-        try:
-            result = urllib.request.urlopen(request, timeout=3)
-            r = json.loads(result.read().decode("utf-8"))
-            TWITCH_OAUTH_TOKEN = r['access_token']
-            TWITCH_OAUTH_EXPIRE_EPOCH = int(r['expires_in']) + round(time.time())
-            logging.debug("oauth token aquired")
-            return
-        except urllib.error.HTTPError as e:
-            logging.warning("Fetch exception caught: %s" % e)
-            logging.warning(e.read().decode())
-            retries += 1
-    logging.error("could not get oauth token from twitch")
-    abort(503)
+    try:
+        r = twitch_client.post(TWITCH_AUTH_URL, data=data).json()
+    except HttpRequestException as e:
+        logging.error("could not get oauth token from twitch: %s" % e)
+        abort(503)
+    TWITCH_OAUTH_TOKEN = r['access_token']
+    TWITCH_OAUTH_EXPIRE_EPOCH = int(r['expires_in']) + round(time.time())
+    logging.debug("oauth token aquired")
 
 
 class NoAudioStreamException(Exception):
@@ -138,9 +343,93 @@ class NoAudioStreamException(Exception):
     pass
 
 
-@cached(cache=TTLCache(maxsize=3000, ttl=VODURLSCACHE_LIFETIME), lock=cache_locks['get_audiostream_url'])
+def check_no_audio(vod_url):
+    """raises NoAudioStreamException right away if the vod recently had no audio stream.
+
+    Args:
+      vod_url: link to the vod
+
+    """
+    entry = caches['no_audio'].get(vod_url)
+    if entry and entry['retry_at'] > time.time():
+        raise NoAudioStreamException(entry['reason'])
+
+
+def record_no_audio(vod_url, reason):
+    """remembers that the vod has no audio stream, the delay before trying it again
+    doubles after every failure up to NOAUDIO_MAX_RETRY_DELAY.
+
+    Args:
+      vod_url: link to the vod
+      reason: the NoAudioStreamException raised by the lookup
+
+    """
+    with cache_locks['no_audio']:
+        entry = caches['no_audio'].get(vod_url)
+        failures = entry['failures'] + 1 if entry else 1
+        delay = min(NOAUDIO_RETRY_DELAY * 2 ** (failures - 1), NOAUDIO_MAX_RETRY_DELAY)
+        caches['no_audio'][vod_url] = {'failures': failures, 'retry_at': time.time() + delay, 'reason': str(reason)}
+    logging.debug("no audio for %s (failure %d), retrying in %d seconds" % (vod_url, failures, delay))
+
+
+@cached(cache=caches['get_audiostream_url'], lock=cache_locks['get_audiostream_url'])
 def get_audiostream_url(vod_url):
-    """finds the audio-strem URL for the given link and returns it.
+    """finds the audio-strem URL for the given link and returns it,
+    failures are cached separately with a shorter lifetime.
+
+    Args:
+      vod_url: link to the vod
+    Returns: the audio stream url
+
+    """
+    check_no_audio(vod_url)
+    try:
+        stream_url = lookup_audiostream_url(vod_url)
+    except NoAudioStreamException as e:
+        record_no_audio(vod_url, e)
+        raise
+    with cache_locks['no_audio']:
+        caches['no_audio'].pop(vod_url, None)
+    return stream_url
+
+
+def get_playlist(vod_id):
+    """returns the parsed audio playlist of the vod, cached so that seeks and retries of the players
+    don't download it again: for VODURLSCACHE_LIFETIME once the vod is finished, for
+    LIVE_PLAYLIST_LIFETIME while it's still being recorded.
+
+    Args:
+      vod_id: the id of the vod
+    Returns: the PlaylistIndex of the audio stream
+
+    """
+    key = keys.hashkey(vod_id)
+    with cache_locks['get_playlist']:
+        playlist = caches['get_playlist'].get(key)
+    if playlist is None:
+        playlist = load_playlist(vod_id)
+        if playlist.complete:
+            with cache_locks['get_playlist']:
+                caches['get_playlist'][key] = playlist
+            with cache_locks['playlist_duration']:
+                caches['playlist_duration'][key] = playlist.duration
+    return playlist
+
+
+@cached(cache=caches['load_playlist'], lock=cache_locks['load_playlist'])
+def load_playlist(vod_id):
+    """downloads and parses the audio playlist of the vod."""
+    return PlaylistIndex.load(get_audiostream_url('https://www.twitch.tv/videos/' + vod_id))
+
+
+def cached_duration(vod_id):
+    """returns the duration in the playlist of the vod if get_playlist() has it and the vod is finished, None otherwise."""
+    with cache_locks['playlist_duration']:
+        return caches['playlist_duration'].get(keys.hashkey(vod_id))
+
+
+def lookup_audiostream_url(vod_url):
+    """asks streamlink for the audio-strem URL of the given link.
 
     Args:
       vod_url: link to the vod
@@ -148,16 +437,50 @@ def get_audiostream_url(vod_url):
 
     """
     logging.debug("looking up audio url for " + vod_url)
+    start = time.time()
+    try:
+        return find_audiostream_url(vod_url)
+    finally:
+        streamlink_seconds.observe(time.time() - start)
+
+
+def get_streamlink_session():
+    """returns the streamlink session, loading streamlink the first time it's needed."""
+    global streamlink_session
+    if streamlink_session is None:
+        with streamlink_session_lock:
+            if streamlink_session is None:
+                start = time.time()
+                from streamlink import Streamlink
+                streamlink_session = Streamlink(options=None)
+                logging.info("streamlink loaded in %.2fs" % (time.time() - start))
+    return streamlink_session
+
+
+def warm_up():
+    """loads streamlink and the other modules only needed by the audio routes in a background thread,
+    called once the server is accepting connections so the index and the cached feeds don't wait for them."""
+    def load():
+        get_streamlink_session()
+        import m3u8  # noqa: F401
+        import dateutil.parser  # noqa: F401
+
+    if WARM_UP:
+        Thread(target=load, name='warm-up', daemon=True).start()
+
+
+def find_audiostream_url(vod_url):
+    """the streamlink lookup of lookup_audiostream_url(), retried on plugin errors."""
+    session = get_streamlink_session()
+    from streamlink.exceptions import PluginError
     tries = 0;
     max_tries = 3;
     while tries < max_tries:
         tries = tries + 1
         try:
-            vod = streamlink_session.streams(vod_url)
+            vod = session.streams(vod_url)
 
             if 'audio' not in vod:
-                #TODO: cache the error in some way to prevent calling streamlink on the same vod
-                #      so to reduce wasted api calls
                 logging.debug("the selected vod does not have an audio stream")
                 raise NoAudioStreamException("no audio stream available")
 
@@ -172,20 +495,611 @@ def get_audiostream_url(vod_url):
 
     raise NoAudioStreamException("could not get the audio stream for uknown reason")
 
-active_transcodes = {}
+
+def resolve_audiostream_url(vod_url):
+    """calls get_audiostream_url, concurrent calls for the same vod share a single lookup.
+
+    Args:
+      vod_url: link to the vod
+    Returns: a (stream_url, error, elapsed_seconds) tuple, stream_url is None if error is set
+
+    """
+    try:
+        check_no_audio(vod_url)
+    except NoAudioStreamException as e:
+        return None, e, 0
+
+    start = time.time()
+    stream_url = None
+    error = None
+    try:
+        stream_url = get_audiostream_url(vod_url)
+    except NoAudioStreamException as e:
+        error = e
+
+    return stream_url, error, time.time() - start
+
+
+def prefetch_audiostream_urls(vod_urls):
+    """resolves the audio stream of all the given vods in parallel using the streamlink pool.
+
+    Args:
+      vod_urls: list of links to the vods
+    Returns: a dict mapping every link to a (stream_url, error) tuple
+
+    """
+    audio_streams = {}
+    # vods known to have no audio are skipped without waiting for a free worker
+    for vod_url in vod_urls:
+        try:
+            check_no_audio(vod_url)
+        except NoAudioStreamException as e:
+            audio_streams[vod_url] = (None, e)
+    vod_urls = [vod_url for vod_url in vod_urls if vod_url not in audio_streams]
+    if not vod_urls:
+        return audio_streams
+
+    start = time.time()
+    results = list(streamlink_pool.map(resolve_audiostream_url, vod_urls))
+    elapsed = time.time() - start
+    serial_elapsed = sum(result[2] for result in results)
+    logging.info("resolved %d audio streams in %.2fs (%.2fs if resolved one after another)" % (len(vod_urls), elapsed, serial_elapsed))
+    for vod_url, (stream_url, error, _) in zip(vod_urls, results):
+        audio_streams[vod_url] = (stream_url, error)
+    return audio_streams
+
+def ffmpeg_command(m3u8_url, start_time, layout, throttle=True):
+    """returns the ffmpeg command that transcodes the audio stream to mp3 on stdout,
+    the output follows the Mp3Layout so bytes can be mapped to time exactly.
+
+    Args:
+      m3u8_url: the audio stream url, or the path of a local playlist
+      start_time: second of the vod the output starts from
+      layout: the Mp3Layout with the bitrate, sample rate and channels of the output
+      throttle: False to leave out the TRANSCODE_BANDWITH_kbps limit, for files nobody is waiting for
+
+    Returns: the command as a list of arguments
+
+    """
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-protocol_whitelist", "file,http,https,tcp,tls,crypto", "-ss", str(start_time), "-i", m3u8_url,
+               "-acodec" ,"libmp3lame", "-ab", str(layout.bitrate/1000)+ "k", "-ar", str(layout.sample_rate), "-ac", str(layout.channels),
+               "-reservoir", "0", "-f", "mp3", "-write_xing", "0", "-id3v2_version", "0"]
+    if throttle:
+        command += ["-bufsize", str(TRANSCODE_SECONDS_BUFFER * layout.bitrate), "-maxrate", str(TRANSCODE_BANDWITH_kbps) + "k"]
+    return command + ["pipe:stdout"]
+
+
+def read_pipe(pipe, chunk_size=TRANSCODE_CHUNK_SIZE):
+    """yields the data written to an unbuffered pipe as soon as it's available, up to chunk_size bytes at a time.
+
+    the data is read with readinto in a single preallocated buffer, so every chunk costs one
+    copy of its bytes instead of allocating chunk_size bytes and shrinking them to the data read.
+
+    Args:
+      pipe: the pipe, opened with bufsize=0
+      chunk_size: size of the buffer
+
+    """
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    while True:
+        read = pipe.readinto(buffer)
+        if not read:
+            return
+        yield bytes(view[:read])
+
+
+def padding(first_byte, sent, size, layout):
+    """returns the silent frames that complete a transcode that ended sent bytes into its size bytes,
+    or None if the gap is too big to be the rounding of the duration and the body must end short."""
+    missing = size - sent
+    if missing > max(TRANSCODE_MIN_PADDING_FRAMES * layout.frame_bytes, TRANSCODE_MAX_PADDING * (first_byte + size)):
+        logging.error("transcode ended %d bytes before its length, not padding it" % missing)
+        return None
+    logging.debug("transcode shorter than expected, padding %d bytes" % missing)
+    return layout.silence(first_byte + sent, missing)
+
+
+class ExactLength:
+    """cuts a transcode to exactly size bytes, the state shared by exact_length() and aexact_length()."""
+
+    def __init__(self, first_byte, size, layout):
+        self.first_byte = first_byte
+        self.size = size
+        self.layout = layout
+        self.sent = 0
+
+    def cut(self, chunk):
+        """returns the part of the next chunk inside the size, done is True once it's reached."""
+        chunk = chunk[:self.size - self.sent]
+        self.sent += len(chunk)
+        return chunk
+
+    @property
+    def done(self):
+        return self.sent >= self.size
+
+    def failed(self, error):
+        logging.error("%s, the response ends %d bytes short" % (error, self.size - self.sent))
+
+    def end(self):
+        """returns the silence completing a transcode that ended early, None if there is none to send."""
+        if self.done:
+            return None
+        return padding(self.first_byte, self.sent, self.size, self.layout)
+
+
+def exact_length(chunks, first_byte, size, layout):
+    """yields exactly size bytes out of chunks, cutting the excess and filling with silent
+    frames if ffmpeg produced a few frames less than the advertised Content-Length.
+    If ffmpeg failed the body ends where its output ended.
+
+    Args:
+      chunks: iterable of bytes, the first one starting at first_byte, raising TranscodeFailedException if ffmpeg failed
+      first_byte: absolute position of the first byte in the mp3
+      size: how many bytes to yield
+      layout: the Mp3Layout of the mp3
+
+    """
+    body = ExactLength(first_byte, size, layout)
+    try:
+        for chunk in chunks:
+            yield body.cut(chunk)
+            if body.done:
+                return
+    except TranscodeFailedException as e:
+        body.failed(e)
+        return
+    silence = body.end()
+    if silence:
+        yield silence
+
+
+async def aexact_length(chunks, first_byte, size, layout):
+    """async version of exact_length(), chunks is an async iterator."""
+    body = ExactLength(first_byte, size, layout)
+    try:
+        async for chunk in chunks:
+            yield body.cut(chunk)
+            if body.done:
+                return
+    except TranscodeFailedException as e:
+        body.failed(e)
+        return
+    finally:
+        await chunks.aclose()
+    silence = body.end()
+    if silence:
+        yield silence
+
+
+def run_process(command, on_start=None):
+    """runs command and yields its stdout, stream_process() is the async version.
+
+    Args:
+      command: the command as a list of arguments
+      on_start: called with the process once it's running
+
+    Raises:
+      TranscodeFailedException: if the command can't be started or exits with an error
+
+    """
+    logging.debug(re.sub(r"[\[|,|\]|\']", "", str(command)))
+    try:
+        # with -loglevel error ffmpeg writes too little on stderr to ever fill the pipe
+        process = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.PIPE, bufsize = 0)
+    except OSError as e:
+        raise TranscodeFailedException("could not start ffmpeg: %s" % e)
+    if on_start:
+        on_start(process)
+    try:
+        yield from read_pipe(process.stdout)
+        if process.wait() != 0:
+            logging.error("ffmpeg error")
+            logging.error(process.stderr.read())
+            raise TranscodeFailedException("ffmpeg exited with %d" % process.returncode)
+    finally:
+        process.kill()
+
+
+async def stream_process(command, on_start=None):
+    """runs command and yields its stdout without blocking the event loop, used by the ASGI server.
+
+    Args:
+      command: the command as a list of arguments
+      on_start: called with the asyncio process once it's running
+
+    Raises:
+      TranscodeFailedException: if the command can't be started or exits with an error
+
+    """
+    logging.debug(re.sub(r"[\[|,|\]|\']", "", str(command)))
+    try:
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        raise TranscodeFailedException("could not start ffmpeg: %s" % e)
+    if on_start:
+        on_start(process)
+    errors = bytearray()
+
+    async def drain_stderr():
+        # an undrained stderr pipe would block ffmpeg once full
+        while True:
+            line = await process.stderr.read(4096)
+            if not line:
+                return
+            errors.extend(line)
+            del errors[:-4096]
+
+    drain = asyncio.ensure_future(drain_stderr())
+    try:
+        while True:
+            data = await process.stdout.read(TRANSCODE_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+        if await process.wait() != 0:
+            await drain
+            logging.error("ffmpeg error")
+            logging.error(bytes(errors))
+            raise TranscodeFailedException("ffmpeg exited with %d" % process.returncode)
+    finally:
+        if process.returncode is None:
+            process.kill()
+        drain.cancel()
+
+
+def fix_length(path, length, layout, name):
+    """truncates or pads with silent frames the finished transcode so that its size is the advertised length.
+    A file too short to be padded is discarded the first time, if the next run comes out short again
+    the vod is shorter than its playlist says and the file is padded anyway, instead of encoding it over and over.
+
+    Args:
+      path: the transcoded file
+      length: the expected size in bytes
+      layout: the Mp3Layout of the file
+      name: the name of the file in the transcode cache
+
+    Raises:
+      TranscodeFailedException: if the file is too short to be completed with a few silent frames
+
+    """
+    size = os.path.getsize(path)
+    if size > length:
+        os.truncate(path, length)
+    elif size < length:
+        silence = padding(0, size, length, layout)
+        if silence is None:
+            with cache_locks['short_transcode']:
+                retried = caches['short_transcode'].get(name)
+                caches['short_transcode'][name] = size
+            if retried is None:
+                raise TranscodeFailedException("the transcode %s is %d bytes shorter than its length" % (path, length - size))
+            logging.warning("the transcode %s came out %d bytes short again, padding it" % (path, length - size))
+            silence = layout.silence(size, length - size)
+        with open(path, 'ab') as output:
+            output.write(silence)
+
+
+def apply_byte_range(response, length):
+    """sets status, Content-Length and Content-Range of the response for the Range requested by the client.
+
+    Args:
+      response: the response to update
+      length: the full size of the media in bytes
+
+    Returns: the (first_byte, last_byte) tuple to send, or None if the range can't be satisfied and the response is a 416
+
+    """
+    first_byte = 0
+    last_byte = length - 1
+    response.accept_ranges = 'bytes'
+    if request.range:
+        byte_range = request.range.range_for_length(length)
+        if byte_range is None:
+            logging.debug("requested range is longer than the media")
+            response.status_code = 416
+            response.content_range = "bytes */" + str(length)
+            return None
+        first_byte, last_byte = byte_range[0], byte_range[1] - 1
+        logging.debug("requested bytes: " + str(first_byte) + "-" + str(last_byte))
+        response.status_code = 206
+        response.content_range = "bytes " + str(first_byte) + "-" + str(last_byte) + "/" + str(length)
+        logging.debug("content range header: " + str(response.content_range))
+    else:
+        response.status_code = 200
+    response.content_length = str(last_byte - first_byte + 1)
+    return first_byte, last_byte
+
+
+transcode_cache = None
+if TRANSCODE_CACHE_DIR:
+    transcode_cache = TranscodeCache(TRANSCODE_CACHE_DIR, TRANSCODE_CACHE_MAX_MB * 1024 * 1024)
+
+# a request waiting for a slot holds one of the worker threads, at least half of them are left to the feeds and the proxy
+transcode_scheduler = TranscodeScheduler(TRANSCODE_MAX_CONCURRENT, min(TRANSCODE_MAX_QUEUE, max(1, REQUEST_THREADS // 2)),
+                                         TRANSCODE_QUEUE_TIMEOUT, TRANSCODE_IDLE_TIMEOUT)
+# fails at the start if a profile can't be encoded with frames of a fixed size
+transcode_layouts = {name: Mp3Layout(*profile) for name, profile in TRANSCODE_PROFILES.items()}
+
+
+def transcode_cache_name(vod_id, layout):
+    """returns the name of the cached transcode of the vod with the given Mp3Layout."""
+    if (layout.sample_rate, layout.channels) == (48000, 2):
+        # the name used before the profiles, the files already cached stay valid
+        return "%s_%d.mp3" % (vod_id, layout.bitrate)
+    return "%s_%d_%d_%d.mp3" % (vod_id, layout.bitrate, layout.sample_rate, layout.channels)
+
+
+def prepare_pretranscode(vod_id, profile):
+    """returns what the pretranscoder needs to write the mp3 of the vod to the transcode cache.
+
+    Args:
+      vod_id: the vod to transcode
+      profile: name of the transcode profile
+
+    Returns: the (cache name, ffmpeg command, expected size, finalize function) tuple
+
+    """
+    m3u8_url = get_audiostream_url('https://www.twitch.tv/videos/' + vod_id)
+    layout = transcode_layouts[profile]
+    length = layout.length(get_playlist(vod_id).duration)
+    name = transcode_cache_name(vod_id, layout)
+    return (name, ffmpeg_command(m3u8_url, 0, layout, throttle=False), length,
+            lambda path: fix_length(path, length, layout, name))
+
+
+pretranscoder = None
+if PRETRANSCODE:
+    if transcode_cache:
+        pretranscoder = Pretranscoder(transcode_cache, prepare_pretranscode, PRETRANSCODE_WORKERS, PRETRANSCODE_MAX_MB * 1024 * 1024,
+                                      PRETRANSCODE_NICENESS, REFRESH_WATCH_WINDOW, PRETRANSCODE_MAX_AGE)
+    else:
+        logging.warning("PRETRANSCODE needs TRANSCODE_CACHE_DIR to store the files, pre-transcoding is disabled")
+
+
+def record_transcode_speed(produced, started, bitrate):
+    """records the speed of a finished transcode compared to realtime.
+
+    Args:
+      produced: bytes written by ffmpeg
+      started: epoch seconds when ffmpeg was started
+      bitrate: bitrate of the mp3 in bit/s
+
+    """
+    elapsed = time.time() - started
+    if produced and elapsed > 0:
+        transcode_speed.observe(produced * 8 / bitrate / elapsed)
+
+
+def transcode_busy(reason):
+    """returns the response for a transcode that could not get a slot.
+
+    Args:
+      reason: the QueueFullException raised by the scheduler
+
+    Returns: a 503 response asking the client to retry later
+
+    """
+    logging.warning("refusing transcode: %s" % reason)
+    response = Response("too many transcodes running, retry later", status=503, mimetype="text/plain")
+    response.headers['Retry-After'] = str(TRANSCODE_QUEUE_TIMEOUT)
+    return response
+
+
 next_transcode_id = random.randint(0, 999999)
-@app.route('/transcode/<string:vod_id>.mp3', methods=['GET'])
-def transcode(vod_id):
-    """given a vod_id it generates an mp3 version of it
+
+
+class TranscodeOutput:
+    """follows the ffmpeg run of a listener for the sync and async bodies of transcode(): drops the bytes
+    before the requested one, keeps the scheduler slot alive and counts the bytes produced."""
+
+    def __init__(self, slot, skip_bytes, bitrate, playlist_path):
+        """
+        Args:
+          slot: the scheduler slot of the transcode, released by close()
+          skip_bytes: bytes of the first frame before the requested one
+          bitrate: bitrate of the mp3 in bit/s
+          playlist_path: the temporary playlist ffmpeg reads, removed by close()
+        """
+        self.slot = slot
+        self.to_skip = skip_bytes
+        self.bitrate = bitrate
+        self.playlist_path = playlist_path
+        self.started = self.touched = time.time()
+        self.produced = self.counted = 0
+
+    def attach(self, process):
+        transcode_scheduler.attach(self.slot, process)
+        logging.debug("active transcodes: " + str(transcode_scheduler.active()))
+
+    def chunk(self, data):
+        """returns the part of a chunk of the ffmpeg output to send."""
+        self.produced += len(data)
+        if self.to_skip:
+            skipped = min(self.to_skip, len(data))
+            data = data[skipped:]
+            self.to_skip -= skipped
+        now = time.time()
+        if now - self.touched > TRANSCODE_ACTIVITY_INTERVAL:
+            transcode_scheduler.touch(self.slot)
+            transcode_bytes.inc(self.produced - self.counted)
+            self.touched, self.counted = now, self.produced
+        return data
+
+    def close(self):
+        transcode_bytes.inc(self.produced - self.counted)
+        record_transcode_speed(self.produced, self.started, self.bitrate)
+        os.remove(self.playlist_path)
+        transcode_scheduler.release(self.slot)
+        logging.debug("active transcodes: " + str(transcode_scheduler.active()))
+
+
+hls_proxy = HlsProxy(HLS_PROXY_CONNECTIONS, HLS_PROXY_PREFETCH, sizes_lifetime=VODURLSCACHE_LIFETIME)
+
+
+@app.route('/proxy/<string:vod_id>.ts', methods=['GET'])
+def proxy(vod_id):
+    """given a vod_id it sends its audio segments one after the other as a single mpeg-ts stream,
+    the segments are downloaded in parallel ahead of the client without using ffmpeg
+
+        Returns: the concatenated segments to the client
+    """
+    stream_url = 'https://www.twitch.tv/videos/' + vod_id
+    try:
+        playlist = get_playlist(vod_id)
+    except NoAudioStreamException as e:
+        logging.info("requester stream could not be found: " + stream_url)
+        return Response(status=404)
+
+    # the segment sizes are learned while they are sent, a seek only asks the ones before the requested bytes
+    sizes = hls_proxy.known_sizes(vod_id, len(playlist.uris))
+    try:
+        if None in sizes and request.range:
+            ranges = request.range.ranges
+            if len(ranges) != 1 or ranges[0][0] < 0:
+                # multiple and suffix ranges need the total length
+                sizes = hls_proxy.probe(vod_id, playlist.uris, math.inf)
+            elif ranges[0] != (0, None):
+                start, stop = ranges[0]
+                sizes = hls_proxy.probe(vod_id, playlist.uris, start if stop is None else stop - 1)
+    except SegmentFetchException as e:
+        logging.error(e)
+        return Response(status=502)
+
+    response = Response(mimetype=AUDIO_MIMETYPES['ts'])
+    if None not in sizes:
+        byte_range = apply_byte_range(response, sum(sizes))
+        if byte_range is None:
+            return response
+        first_byte, last_byte = byte_range
+    elif request.range and request.range.ranges[0] != (0, None):
+        # the total length isn't known yet, the range is answered up to the last segment of known size
+        start, stop = request.range.ranges[0]
+        known = 0
+        for size in sizes:
+            if size is None:
+                break
+            known += size
+        first_byte = start
+        last_byte = known - 1 if stop is None else min(stop, known) - 1
+        response.accept_ranges = 'bytes'
+        response.status_code = 206
+        response.headers['Content-Range'] = "bytes %d-%d/*" % (first_byte, last_byte)
+        response.content_length = last_byte - first_byte + 1
+    else:
+        # the first listener gets the whole vod right away, without a Content-Length
+        first_byte, last_byte = 0, None
+        response.accept_ranges = 'bytes'
+
+    def generate():
+        try:
+            yield from hls_proxy.stream(vod_id, playlist.uris, sizes, first_byte, last_byte)
+        except SegmentFetchException as e:
+            logging.error(e)
+
+    async def agenerate():
+        segments = hls_proxy.astream(vod_id, playlist.uris, sizes, first_byte, last_byte)
+        try:
+            async for data in segments:
+                yield data
+        except SegmentFetchException as e:
+            logging.error(e)
+        finally:
+            await segments.aclose()
+
+    response.response = stream_with_context(generate())
+    # the ASGI server streams async_body instead of the response, see asgi.py
+    response.async_body = agenerate
+    if first_byte == 0:
+        logging.info('requested proxy for: ' + stream_url)
+    return response
+
+
+@app.route('/audio/<string:vod_id>.<string:audio_format>', methods=['GET'])
+def remux(vod_id, audio_format):
+    """given a vod_id it copies its aac audio in an adts (.aac) or fragmented mp4 (.m4a) stream,
+    no re-encoding is done so it costs almost no cpu compared to the mp3 transcoding
+
+        Returns: the ffmpeg remuxed output to the client
+    """
+    if audio_format not in REMUX_FORMATS:
+        abort(404)
+
+    stream_url = 'https://www.twitch.tv/videos/' + vod_id
+    try:
+        m3u8_url = get_audiostream_url(stream_url)
+    except NoAudioStreamException as e:
+        logging.info("requester stream could not be found: " + stream_url)
+        return Response(status=404)
+
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", m3u8_url, "-vn", "-c:a", "copy"] + REMUX_FORMATS[audio_format] + ["pipe:stdout"]
+
+    # remuxes take a slot like the transcodes, the slot is released when the body ends so it's never reaped
+    try:
+        slot = transcode_scheduler.acquire("remux_%s_%s" % (vod_id, audio_format), request.remote_addr, reapable=False)
+    except QueueFullException as e:
+        return transcode_busy(e)
+
+    def generate():
+        try:
+            yield from run_process(command, on_start=lambda process: transcode_scheduler.attach(slot, process))
+        except TranscodeFailedException as e:
+            logging.error(e)
+        finally:
+            transcode_scheduler.release(slot)
+
+    async def agenerate():
+        output = stream_process(command, on_start=lambda process: transcode_scheduler.attach(slot, process))
+        try:
+            async for data in output:
+                yield data
+        except TranscodeFailedException as e:
+            logging.error(e)
+        finally:
+            await output.aclose()
+            transcode_scheduler.release(slot)
+
+    # the size of the copied stream is not known in advance, so seeking is not supported
+    response = Response(stream_with_context(generate()), mimetype=AUDIO_MIMETYPES[audio_format])
+    response.accept_ranges = 'none'
+    response.async_body = agenerate
+    # frees the slot even if the client went away before the body was generated
+    response.call_on_close(lambda: transcode_scheduler.release(slot))
+    logging.info('requested remuxing to %s for: %s' % (audio_format, stream_url))
+    return response
+
+
+@app.route('/transcode/<string:vod_id>.mp3', methods=['GET'], defaults={'profile': DEFAULT_TRANSCODE_PROFILE})
+@app.route('/transcode/<string:profile>/<string:vod_id>.mp3', methods=['GET'])
+def transcode(vod_id, profile):
+    """given a vod_id it generates an mp3 version of it with the settings of the transcode profile
 
         Returns: the ffmpeg transcoded output to the client
     """
+    layout = transcode_layouts.get(profile)
+    if layout is None:
+        abort(404)
+    bitrate = layout.bitrate
+    cache_name = transcode_cache_name(vod_id, layout)
+    if transcode_cache:
+        cached_path = transcode_cache.complete_path(cache_name)
+        if cached_path:
+            logging.debug("serving cached transcode: " + cached_path)
+            # gunicorn sends whole files with sendfile, without copying them through python
+            response = send_file(cached_path, mimetype="audio/mpeg", conditional=True)
+            content_range = response.content_range
+            if content_range and content_range.start is not None:
+                start, stop = content_range.start, content_range.stop
+            else:
+                start, stop = 0, os.path.getsize(cached_path)
+            response.async_body = lambda: transcode_cache.atail(cache_name, start, stop - start)
+            return response
+
     response = Response(mimetype = "audio/mpeg")
 
     session_id = None
     stream_url = 'https://www.twitch.tv/videos/' + vod_id
-    start_time = 0
-    requested_bytes = 0
     try:
         m3u8_url = get_audiostream_url(stream_url)
     except NoAudioStreamException as e:
@@ -193,16 +1107,10 @@ def transcode(vod_id):
         response.status_code = 404
         return response
 
-    def get_duration_m3u8(line, lineno, data, state):
-        if line.startswith('#EXT-X-TWITCH-TOTAL-SECS'):
-            custom_tag = line.split(':')
-            data['duration'] = custom_tag[1].strip()
+    playlist = get_playlist(vod_id)
 
-    playlist = m3u8.load(m3u8_url, custom_tags_parser=get_duration_m3u8)
-
-    bitrate = TRANSCODE_BITRATE
-    duration = int(round(float(playlist.data['duration'])))
-    length = int(round(bitrate/8 * duration))
+    duration = playlist.duration
+    length = layout.length(duration)
 
 
     if request.cookies.get("session_id") is None:
@@ -214,25 +1122,15 @@ def transcode(vod_id):
         session_id = int(request.cookies.get('session_id'))
 
 
-    if 'Range' in request.headers:
-        requested_bytes = int(request.headers.get("Range").split("=")[1].split("-")[0])
-        logging.debug("requested bytes: " + str(requested_bytes))
-        start_time = round((int(requested_bytes) / length) * duration)
-        if start_time > duration or requested_bytes > length:
-            logging.debug("requested range is longer than the media")
-            response.status_code = 416
-            return response
-
+    byte_range = apply_byte_range(response, length)
+    if byte_range is None:
+        return response
+    first_byte, last_byte = byte_range
+    size = last_byte - first_byte + 1
 
-    response.accept_ranges = 'bytes'
-    response.content_range = "bytes " + str(requested_bytes) + "-" + str(length-1) + "/" +str(length)
-    if start_time > 0:
-        response.status_code = 206
-        response.content_length = str(length - requested_bytes)
-        logging.debug("content range header: " + str(response.content_range))
-    else:
-        response.status_code = 200
-        response.content_length = str(length)
+    # ffmpeg starts from the frame containing first_byte, the bytes before it in the frame are skipped
+    start_time = layout.time_at(first_byte)
+    skip_bytes = first_byte - layout.frame_at(first_byte) * layout.frame_bytes
 
     logging.debug("stream_url: " + stream_url)
     logging.debug("m3u8_url: " + m3u8_url)
@@ -241,65 +1139,87 @@ def transcode(vod_id):
     logging.debug("duration in seconds: " + str(duration))
     logging.debug("byte length: " + str(length))
 
-    def get_transcode_id():
-        return str(session_id) + "_" + str(vod_id)
-
-
-    def generate():
-        buff = []
-        stream_url = 'https://www.twitch.tv/videos/' + vod_id
+    if transcode_cache and playlist.complete:
+        # every listener shares the same ffmpeg run, a seek can be served from the cache
+        # only if the requested bytes have already been written.
+        # A vod still being recorded would be cached with the length it has now, it's transcoded for every listener
+        if first_byte == 0 and transcode_cache.needs_writer(cache_name):
+            try:
+                writer_slot = transcode_scheduler.acquire("cache_" + cache_name, session_id, seek=False, reapable=False)
+            except QueueFullException as e:
+                return transcode_busy(e)
+            started = time.time()
 
-        # kill any transcode with no activity in 10 minutes
-        try:
-            stalled_transcodes_ids = [k for k in active_transcodes if active_transcodes[k].last_active + 60*10 < round(time.time())]
-            for key in stalled_transcodes_ids:
-                logging.info("killing stalled transcode with id: " + str(key))
-                active_transcodes[key].kill()
-                active_transcodes.pop(key)
-        except KeyError:
-            # during cuncurrent requests is possible to have this block to execute cuncurrently
-            pass
+            def finalize(path):
+                produced = os.path.getsize(path)
+                transcode_bytes.inc(produced)
+                record_transcode_speed(produced, started, bitrate)
+                fix_length(path, length, layout, cache_name)
 
-        if get_transcode_id() in active_transcodes:
-            logging.debug("killing old trascoding process: " + get_transcode_id())
-            active_transcodes[get_transcode_id()].kill()
-            active_transcodes.pop(get_transcode_id())
+            try:
+                process = transcode_cache.start(cache_name, ffmpeg_command(m3u8_url, 0, layout), finalize=finalize,
+                                                on_exit=lambda process: transcode_scheduler.release(writer_slot))
+            except Exception:
+                # the slot is not reapable, nothing else would give it back
+                transcode_scheduler.release(writer_slot)
+                raise
+            if process:
+                transcode_scheduler.attach(writer_slot, process)
+            else:
+                transcode_scheduler.release(writer_slot)
+        if first_byte == 0 or transcode_cache.written_bytes(cache_name) > first_byte:
+            # the finished file already has the exact length, a failed writer ends the body short
+            response.response = stream_with_context(exact_length(transcode_cache.tail(cache_name, first_byte), first_byte, size, layout))
+            response.async_body = lambda: aexact_length(transcode_cache.atail(cache_name, first_byte), first_byte, size, layout)
+            if first_byte == 0:
+                logging.info('requested transcoding for:' + stream_url)
+            return response
 
+    transcode_id = str(session_id) + "_" + str(vod_id)
 
-        ffmpeg_command = ["ffmpeg", "-ss", str(start_time), "-i", m3u8_url, "-acodec" ,"libmp3lame", "-ab", str(bitrate/1000)+ "k", "-f", "mp3", "-bufsize", str(TRANSCODE_SECONDS_BUFFER * bitrate), "-maxrate", str(TRANSCODE_BANDWITH_kbps) + "k", "pipe:stdout"]
-        logging.debug(re.sub(r"[\[|,|\]|\']", "", str(ffmpeg_command)))
-        process = subprocess.Popen(ffmpeg_command, stdout = subprocess.PIPE, stderr = subprocess.PIPE, bufsize = -1)
-        active_transcodes[get_transcode_id()] = process
-        active_transcodes[get_transcode_id()].last_active = round(time.time())
-        logging.debug("active transcodes: " + str(active_transcodes.keys()))
+    # a new request from the same client replaces its old transcode of the same vod
+    transcode_scheduler.kill(transcode_id)
+    try:
+        slot = transcode_scheduler.acquire(transcode_id, session_id, seek=first_byte > 0)
+    except QueueFullException as e:
+        return transcode_busy(e)
+
+    def prepare_command():
+        # seeks start downloading from the segment containing start_time
+        segment, segment_offset = playlist.segment_at(start_time)
+        playlist_file = tempfile.NamedTemporaryFile('w', suffix='.m3u8', delete=False)
+        with playlist_file:
+            playlist_file.write(playlist.playlist_from(segment))
+        return ffmpeg_command(playlist_file.name, segment_offset, layout), playlist_file.name
 
+    def generate():
+        command, playlist_path = prepare_command()
+        output = TranscodeOutput(slot, skip_bytes, bitrate, playlist_path)
+        process = run_process(command, on_start=output.attach)
+        try:
+            for data in process:
+                yield output.chunk(data)
+        finally:
+            process.close()
+            output.close()
 
+    async def agenerate():
+        command, playlist_path = prepare_command()
+        output = TranscodeOutput(slot, skip_bytes, bitrate, playlist_path)
+        process = stream_process(command, on_start=output.attach)
         try:
-            while True:
-                line = process.stdout.read(1024)
-                buff.append(line)
-
-                active_transcodes[get_transcode_id()] = process
-                active_transcodes[get_transcode_id()].last_active = round(time.time())
-                yield buff.pop(0)
-
-                process.poll()
-                if isinstance(process.returncode, int):
-                    if process.returncode > 0:
-                        logging.error("ffmpeg error")
-                        logging.error(process.stderr.read())
-                    if get_transcode_id() in active_transcodes:
-                        active_transcodes.pop(get_transcode_id())
-                    break
+            async for data in process:
+                yield output.chunk(data)
         finally:
-            process.kill()
-            if get_transcode_id() in active_transcodes:
-                active_transcodes.pop(get_transcode_id())
-                logging.debug("active_transcodes: " + str(active_transcodes.keys()))
+            await process.aclose()
+            output.close()
 
-    response.response = stream_with_context(generate())
+    response.response = stream_with_context(exact_length(generate(), first_byte, size, layout))
+    response.async_body = lambda: aexact_length(agenerate(), first_byte, size, layout)
+    # frees the slot even if the client went away before the body was generated
+    response.call_on_close(lambda: transcode_scheduler.release(slot))
 
-    if start_time == 0:
+    if first_byte == 0:
         logging.info('requested transcoding for:' + stream_url)
 
     return response
@@ -343,6 +1263,96 @@ def index():
     return render_template('index.html')
 
 
+@app.route('/metrics')
+def prometheus_metrics():
+    """process request to /metrics.
+
+        Returns: the counters of the worker answering, in the Prometheus text format
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.time()
+
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.endpoint if request.url_rule else 'unknown'
+    if 'request_start' in g:
+        request_seconds.observe(time.time() - g.request_start, route)
+    responses_total.inc(1, route, response.status_code)
+    return response
+
+
+def collect_cache_entries():
+    entries = []
+    for name, cache in caches.items():
+        with cache_locks[name]:
+            entries.append(((name,), len(cache)))
+    return entries
+
+
+def collect_upstream(field):
+    return lambda: [((endpoint,), counter[field]) for endpoint, counter in sorted(twitch_client.stats().items())]
+
+
+def collect_cache_requests():
+    return [((name, result), counter[result]) for name, counter in sorted(cache_stats().items())
+            for result in ('hits', 'misses', 'coalesced')]
+
+
+metrics.Collected('twitchrss_cache_requests_total', 'calls of the cached functions by result (hits, misses, coalesced)',
+                  'counter', ['cache', 'result'], collect_cache_requests)
+metrics.Collected('twitchrss_cache_entries', 'entries stored in the caches', 'gauge', ['cache'], collect_cache_entries)
+metrics.Collected('twitchrss_upstream_requests_total', 'tries of the twitch API requests', 'counter', ['endpoint'],
+                  collect_upstream('requests'))
+metrics.Collected('twitchrss_upstream_errors_total', 'failed tries of the twitch API requests', 'counter', ['endpoint'],
+                  collect_upstream('errors'))
+metrics.Collected('twitchrss_upstream_retries_total', 'tries of the twitch API requests that were retries', 'counter', ['endpoint'],
+                  collect_upstream('retries'))
+metrics.Collected('twitchrss_rate_limit_retry_after_seconds', 'seconds until the next twitch API request is allowed', 'gauge', [],
+                  lambda: [((), twitch_rate_limit.retry_after())])
+metrics.Collected('twitchrss_transcodes_running', 'ffmpeg processes holding a transcode slot', 'gauge', [],
+                  lambda: [((), len(transcode_scheduler.active()))])
+metrics.Collected('twitchrss_transcodes_queued', 'transcode requests waiting for a slot', 'gauge', [],
+                  lambda: [((), transcode_scheduler.queued())])
+if pretranscoder:
+    metrics.Collected('twitchrss_pretranscodes_queued', 'new vods waiting for or being pre-transcoded', 'gauge', [],
+                      lambda: [((), pretranscoder.queued())])
+
+
+# the fields of the twitch data construct_rss() reads, the others (like view_count) never change the feed
+FEED_USER_FIELDS = ('login', 'display_name', 'profile_image_url')
+FEED_VOD_FIELDS = ('id', 'stream_id', 'url', 'title', 'description', 'thumbnail_url', 'duration', 'created_at')
+
+
+def feed_fingerprint(user, vods, streams, sort_by):
+    """returns a hash of the data the feed is made from, used to reuse the cached feed and as its ETag.
+    The durations of the playlists already downloaded are part of it, they give the exact length and duration of the episodes.
+
+    Args:
+      user: the user dict
+      vods: the list of vod dicts
+      streams: the list of stream dicts
+      sort_by: the vod field the feed is sorted by, it's part of the feed even if it's not displayed
+
+    Returns: the hex digest
+
+    """
+    vod_fields = FEED_VOD_FIELDS + (sort_by,)
+    data = [
+        [user.get(field) for field in FEED_USER_FIELDS],
+        [[vod.get(field) for field in vod_fields] for vod in vods],
+        # only the first live stream is compared with the vods
+        [stream.get('id') for stream in streams[:1]],
+        [(vod.get('id'), duration) for vod, duration in
+         ((vod, cached_duration(vod.get('id'))) for vod in vods) if duration is not None],
+    ]
+    return hashlib.sha1(json.dumps(data).encode('utf-8')).hexdigest()
+
+
 def process_channel(channel, request):
     """process the given channel.
 
@@ -351,7 +1361,7 @@ def process_channel(channel, request):
       request: the request object from flask
 
     Returns:
-      rss_data: the fully formed rss feed
+      the http response with the fully formed rss feed, or a 304 if the client copy is still valid
 
     """
     include_streaming = True if request.args.get("include_streaming", "False").lower() == "true" else False
@@ -359,28 +1369,101 @@ def process_channel(channel, request):
     desc = True if request.args.get("desc", "False").lower() == "true" else False
     links_only = True if request.args.get("links_only", "False").lower() == "true" else False
     transcode = True if request.args.get("transcode", str(TRANSCODE)).lower() == "true" else False
+    audio_format = request.args.get("format", TRANSCODE_FORMAT).lower()
+    if audio_format not in AUDIO_MIMETYPES:
+        audio_format = 'mp3'
+    profile = request.args.get("profile", DEFAULT_TRANSCODE_PROFILE).lower()
+    if profile not in transcode_layouts:
+        profile = DEFAULT_TRANSCODE_PROFILE
 
     try:
-        user_data = json.loads(fetch_channel(channel))['data'][0]
+        user_json = fetch_channel(channel)
+        user_data = json.loads(user_json)['data'][0]
         channel_id = user_data['id']
-        vods_data = json.loads(fetch_vods(channel_id))['data']
-        streams_data = json.loads(fetch_streams(channel_id))['data']
+        vods_json = fetch_vods(channel_id)
+        vods_data = json.loads(vods_json)['data']
+        streams_json = fetch_streams(channel_id)
+        streams_data = json.loads(streams_json)['data']
     except KeyError as e:
         logging.error("could not fetch data for the given request")
         logging.error(e)
         abort(404)
 
-    rss_data = construct_rss(user_data, vods_data, streams_data, include_streaming, sort_by=sort_by, desc_sort=desc, links_only=links_only, transcode = transcode, request = request)
-    headers = {'Content-Type': 'text/xml'}
+    if feed_refresher:
+        feed_refresher.hit(channel.lower(), not links_only and not transcode)
+    if pretranscoder and transcode and audio_format == 'mp3' and not links_only:
+        pretranscoder.watch(channel_id, profile)
+        pretranscoder.notice(channel_id, vods_data, [stream['id'] for stream in streams_data])
+
+    # the feed only changes when the twitch data it's made from changes
+    feed_key = (channel.lower(), include_streaming, sort_by, desc, links_only, transcode, audio_format, profile, request.host_url)
+    fingerprint = feed_fingerprint(user_data, vods_data, streams_data, sort_by)
+    entry = caches['feed'].get(feed_key)
+    if entry is None or entry['fingerprint'] != fingerprint:
+        start = time.time()
+        rss_data, gzip_data = rss_writer.encode(construct_rss(user_data, vods_data, streams_data, include_streaming, sort_by=sort_by, desc_sort=desc, links_only=links_only, transcode = transcode, audio_format = audio_format, profile = profile, request = request))
+        feed_build_seconds.observe(time.time() - start)
+        feed_bytes.observe(len(rss_data))
+        entry = {
+            'fingerprint': fingerprint,
+            'rss': rss_data,
+            'gzip': gzip_data,
+            'last_modified': datetime.datetime.utcnow().replace(microsecond=0),
+        }
+        # feeds with missing audio streams are not kept, so they are retried on the next request
+        if AUDIO_ERROR_MESSAGE.encode() not in rss_data:
+            with cache_locks['feed']:
+                caches['feed'][feed_key] = entry
+    else:
+        logging.debug("serving cached feed for " + channel)
 
+    response = Response(entry['rss'], content_type='text/xml')
+    etag = fingerprint
     if 'gzip' in request.headers.get("Accept-Encoding", ''):
-        headers['Content-Encoding'] = 'gzip'
-        rss_data = gzip.compress(rss_data)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_data(entry['gzip'])
+        etag += '-gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(etag)
+    response.last_modified = entry['last_modified']
+
+    return response.make_conditional(request)
 
-    return rss_data, headers
 
+def stale_on_rate_limit(name):
+    """decorator that remembers the last result of a twitch fetch function and returns it
+    when the rate limit is exhausted, instead of waiting for new tokens.
 
-@cached(cache=TTLCache(maxsize=3000, ttl=USERIDCACHE_LIFETIME), lock=cache_locks['fetch_channel'])
+    Args:
+      name: unique name of the decorated function
+
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args):
+            key = (name,) + args
+            try:
+                result = func(*args)
+            except RateLimitedException as e:
+                with cache_locks['stale']:
+                    stale = caches['stale'].get(key)
+                rate_limited_total.inc(1, 'nothing' if stale is None else 'stale')
+                if stale is None:
+                    logging.warning("%s, nothing cached for %s" % (e, key))
+                    response = Response("twitch rate limit reached, retry later", status=503, mimetype="text/plain")
+                    response.headers['Retry-After'] = str(max(1, round(twitch_rate_limit.retry_after())))
+                    abort(response)
+                logging.warning("%s, serving stale data for %s" % (e, key))
+                return stale
+            with cache_locks['stale']:
+                caches['stale'][key] = result
+            return result
+        return wrapper
+    return decorator
+
+
+@cached(cache=caches['fetch_channel'], lock=cache_locks['fetch_channel'])
+@stale_on_rate_limit('fetch_channel')
 def fetch_channel(channel_name):
     """fetches the JSON for the given channel username.
 
@@ -390,10 +1473,11 @@ def fetch_channel(channel_name):
     Returns: the JSON formatted channel info
 
     """
-    return fetch_json(channel_name, USERID_URL_TEMPLATE)
+    return json.dumps({'data': helix_batcher.get('users', channel_name.lower()) or []}).encode('utf-8')
 
 
-@cached(cache=TTLCache(maxsize=500, ttl=VODCACHE_LIFETIME), lock=cache_locks['fetch_vods'])
+@cached(cache=caches['fetch_vods'], lock=cache_locks['fetch_vods'])
+@stale_on_rate_limit('fetch_vods')
 def fetch_vods(channel_id):
     """fetches the JSON for the given channel username.
 
@@ -402,10 +1486,72 @@ def fetch_vods(channel_id):
     Returns: the JSON formatted vods list
 
     """
+    if FULL_VOD_HISTORY:
+        return json.dumps({'data': fetch_vod_history(channel_id), 'pagination': {}}).encode('utf-8')
     return fetch_json(channel_id, VOD_URL_TEMPLATE)
 
 
-@cached(cache=TTLCache(maxsize=500, ttl=VODCACHE_LIFETIME), lock=cache_locks['fetch_streams'])
+def fetch_vod_page(channel_id, cursor=None):
+    """fetches one page of up to 100 vods, the newest first.
+
+    Args:
+      channel_id: the unique identifier of the channel
+      cursor: the pagination cursor of the previous page, None for the first page
+
+    Returns: a (vods, next_cursor) tuple, next_cursor is None on the last page
+
+    """
+    url_template = VOD_PAGE_URL_TEMPLATE
+    if cursor:
+        # the cursor is opaque and can contain + / =, the template is then formatted with %
+        url_template += '&after=' + quote(cursor, safe='').replace('%', '%%')
+    page = json.loads(fetch_json(channel_id, url_template))
+    return page['data'], page.get('pagination', {}).get('cursor')
+
+
+def fetch_vod_history(channel_id):
+    """returns every vod of the channel, keeping them in the vod_index cache.
+
+    the whole history is downloaded following the pagination cursor only the first time and
+    once every VOD_HISTORY_RESYNC seconds (to forget the deleted vods), the other times only
+    the newest page is fetched and merged into the stored list by vod id.
+
+    Args:
+      channel_id: the unique identifier of the channel
+
+    Returns: the list of vods, the newest first
+
+    """
+    with cache_locks['vod_index']:
+        index = caches['vod_index'].get(channel_id)
+
+    newest, cursor = fetch_vod_page(channel_id)
+    if index is None or index['synced'] + VOD_HISTORY_RESYNC < time.time():
+        vods = newest
+        pages = 1
+        while cursor and pages < VOD_HISTORY_MAX_PAGES:
+            page, cursor = fetch_vod_page(channel_id, cursor)
+            vods.extend(page)
+            pages += 1
+        logging.info("fetched the full history of %s: %d vods in %d requests" % (channel_id, len(vods), pages))
+        index = {'vods': vods, 'synced': time.time()}
+    elif cursor is None:
+        # the whole history fits in one page
+        index = {'vods': newest, 'synced': index['synced']}
+    else:
+        # the page replaces the stored vods in its time span, a stored vod of that span
+        # missing from the page was deleted, so only the older ones are kept
+        oldest = min(vod['created_at'] for vod in newest)
+        older = [vod for vod in index['vods'] if vod['created_at'] < oldest]
+        index = {'vods': newest + older, 'synced': index['synced']}
+
+    with cache_locks['vod_index']:
+        caches['vod_index'][channel_id] = index
+    return index['vods']
+
+
+@cached(cache=caches['fetch_streams'], lock=cache_locks['fetch_streams'])
+@stale_on_rate_limit('fetch_streams')
 def fetch_streams(user_id):
     """fetches the JSON formatted list of streams for the give user
 
@@ -415,7 +1561,33 @@ def fetch_streams(user_id):
     Returns: the JSON formatted vods list
 
     """
-    return fetch_json(user_id, STREAMS_URL_TEMPLATE)
+    return json.dumps({'data': helix_batcher.get('streams', user_id) or []}).encode('utf-8')
+
+
+def fetch_helix_batch(endpoint, values):
+    """fetches up to 100 users or streams with a single helix request, used by helix_batcher.
+
+    Args:
+      endpoint: one of the keys of HELIX_BATCH_FIELDS
+      values: the logins or user ids to look up
+
+    Returns: a dict with the list of items returned for every value
+
+    """
+    field = HELIX_BATCH_FIELDS[endpoint]
+    query = [(field, value) for value in values]
+    if endpoint == 'streams':
+        # the default page size is 20, one user has at most one stream
+        query.append(('first', 100))
+    data = json.loads(fetch_json(endpoint + '?' + urlencode(query), HELIX_BATCH_URL_TEMPLATE))['data']
+    results = {}
+    for item in data:
+        results.setdefault(item[field].lower(), []).append(item)
+    return results
+
+
+# the users and streams lookups of concurrent requests are sent together
+helix_batcher = RequestBatcher(fetch_helix_batch, max_batch=100)
 
 
 def get_auth_headers():
@@ -431,8 +1603,16 @@ def get_auth_headers():
     }
 
 
-@sleep_and_retry
-@limits(calls=800, period=60)
+def sync_rate_limit(response):
+    """updates the rate limiter with the Ratelimit-* headers of a helix response."""
+    headers = response.headers
+    try:
+        limit = int(headers['Ratelimit-Limit']) if 'Ratelimit-Limit' in headers else None
+        twitch_rate_limit.sync(limit, int(headers['Ratelimit-Remaining']), int(headers['Ratelimit-Reset']))
+    except (KeyError, ValueError):
+        pass
+
+
 def fetch_json(id, url_template):
     """fetches a JSON from the given URL template and generic id.
 
@@ -441,30 +1621,104 @@ def fetch_json(id, url_template):
       url_template: the template for the request where id will be replaced example: 'https://api.twitch.tv/helix/videos?user_id=%s&type=all'
 
     Returns: the JSON response for the request
+    Raises: RateLimitedException if the request would exceed the twitch rate limit
 
     """
+    if not twitch_rate_limit.acquire():
+        raise RateLimitedException("twitch rate limit reached")
     url = url_template % id
-    headers = get_auth_headers()
-    headers['Accept-Encoding'] = 'gzip'
-    request = urllib.request.Request(url, headers=headers)
-    retries = 0
-    while retries < 3:
-        try:
-            result = urllib.request.urlopen(request, timeout=3)
-            logging.debug('Fetch from twitch for %s with code %s' % (id, result.getcode()))
-            if result.info().get('Content-Encoding') == 'gzip':
-                logging.debug('Fetched gzip content')
-                return gzip.decompress(result.read())
-            return result.read()
-        except urllib.error.HTTPError as e:
-            logging.warning("Fetch exception caught: %s" % e)
-            logging.warning(e.read().decode())
-            retries += 1
-    logging.error("max retries reached, could not get resource, id: " + id)
-    abort(503)
-
-
-def construct_rss(user, vods, streams, include_streams=False, sort_by="published_at", desc_sort=False, links_only=False, transcode = TRANSCODE, request=None):
+    # requests asks for gzip and decompresses it by itself
+    try:
+        result = twitch_client.get(url, headers=get_auth_headers())
+    except HttpRequestException as e:
+        if e.response is not None:
+            sync_rate_limit(e.response)
+            if e.response.status_code == 429:
+                raise RateLimitedException("twitch answered 429 too many requests")
+        logging.error("max retries reached, could not get resource, id: %s (%s)" % (id, e))
+        abort(503)
+    sync_rate_limit(result)
+    logging.debug('Fetch from twitch for %s with code %s' % (id, result.status_code))
+    return result.content
+
+
+def prepare_refresh(channels):
+    """fetches the users and the live streams of all the channels due for a refresh with one helix request each,
+    instead of one per channel, called by the background refresher before refresh_channel().
+
+    Args:
+      channels: the channel names
+
+    Returns: a dict with the (user data, streams JSON) of every channel that exists
+
+    """
+    users = {}
+    missing = []
+    with cache_locks['fetch_channel']:
+        for channel in channels:
+            cached_user = caches['fetch_channel'].get(keys.hashkey(channel))
+            if cached_user is None:
+                missing.append(channel)
+            else:
+                users[channel] = json.loads(cached_user)['data']
+    for channel, data in helix_batcher.get_many('users', missing).items():
+        users[channel] = data or []
+        with cache_locks['fetch_channel']:
+            caches['fetch_channel'][keys.hashkey(channel)] = json.dumps({'data': users[channel]}).encode('utf-8')
+
+    users = {channel: data[0] for channel, data in users.items() if data}
+    streams = helix_batcher.get_many('streams', [user['id'] for user in users.values()])
+    prepared = {}
+    for channel, user in users.items():
+        streams_json = json.dumps({'data': streams[user['id']] or []}).encode('utf-8')
+        with cache_locks['stale']:
+            caches['stale'][('fetch_streams', user['id'])] = streams_json
+        prepared[channel] = (user, streams_json)
+    return prepared
+
+
+def refresh_channel(channel, options, prepared=None):
+    """refreshes the cached vods and streams of the channel, called by the background refresher
+    shortly before the cache expires so that clients are always served from a warm cache.
+
+    Args:
+      channel: the channel name
+      options: the set of options the feed was requested with, True if the audio streams are used
+      prepared: the (user data, streams JSON) of the channel fetched by prepare_refresh(), None to fetch them here
+
+    """
+    if prepared:
+        user_data, streams_json = prepared
+    else:
+        user_data = json.loads(fetch_channel(channel))['data'][0]
+        streams_json = None
+    channel_id = user_data['id']
+    key = keys.hashkey(channel_id)
+    vods_json = fetch_vods.__wrapped__(channel_id)
+    if streams_json is None:
+        streams_json = fetch_streams.__wrapped__(channel_id)
+    with cache_locks['fetch_vods']:
+        caches['fetch_vods'][key] = vods_json
+    with cache_locks['fetch_streams']:
+        caches['fetch_streams'][key] = streams_json
+
+    vods_data = json.loads(vods_json)['data']
+    if True in options:
+        vod_urls = [vod['url'] for vod in vods_data if 'url' in vod]
+        prefetch_audiostream_urls(vod_urls)
+    if pretranscoder:
+        pretranscoder.notice(channel_id, vods_data, [stream['id'] for stream in json.loads(streams_json)['data']])
+
+
+feed_refresher = None
+if BACKGROUND_REFRESH:
+    # with a shared cache only one of the workers refreshes a channel
+    refresh_leases = SharedLeases(CACHE_DB, 'refresh') if CACHE_DB else None
+    feed_refresher = BackgroundRefresher(refresh_channel, VODCACHE_LIFETIME, REFRESH_MARGIN, REFRESH_WORKERS, REFRESH_WATCH_WINDOW,
+                                         leases=refresh_leases, prepare=prepare_refresh)
+
+
+def construct_rss(user, vods, streams, include_streams=False, sort_by="published_at", desc_sort=False, links_only=False, transcode = TRANSCODE, audio_format = 'mp3', profile = DEFAULT_TRANSCODE_PROFILE, request=None):
     """returns the RSS for the given inputs.
 
     Args:
@@ -475,8 +1729,10 @@ def construct_rss(user, vods, streams, include_streams=False, sort_by="published
       sort_by: the key to sort by, the keys are the same used by the twitch API https://dev.twitch.tv/docs/api/reference#get-videos
       desc_sort: True if the sort must be done in ascending oreder
       links_only: if True the audio stream will not be fetched, makes the feed generation very fast
+      audio_format: when transcoding, mp3 to re-encode the audio, aac/m4a to only copy it in a new container or ts to proxy the segments as they are
+      profile: name of the transcode profile of the mp3 enclosures
 
-    Returns: fully formatted RSS string
+    Returns: generator of the text chunks of the fully formatted RSS
 
     """
 
@@ -499,37 +1755,38 @@ def construct_rss(user, vods, streams, include_streams=False, sort_by="published
         logging.debug("streams data:")
         logging.debug(streams)
 
-    feed = FeedGenerator()
-    feed.load_extension('podcast')
-
-    # Set the feed/channel level properties
-    feed.image(url=icon)
-    feed.id("https://github.com/madiele/TwitchToPodcastRSS")
-    feed.title("%s's Twitch video RSS" % display_name)
-    feed.link(href='https://www.twitch.tv/' + channel_name, rel='self')
-    feed.author(name="Generated by TwitchToPodcastRSS")
-    feed.description("The RSS Feed of %s's videos on Twitch" % display_name)
-    feed.podcast.itunes_author("Twitch RSS Generated")
-    feed.podcast.itunes_complete(False)
-    feed.podcast.itunes_explicit('no')
-    feed.podcast.itunes_image(icon)
-    feed.podcast.itunes_summary("The RSS Feed of %s's videos on Twitch" % display_name)
+    yield rss_writer.channel(
+        title="%s's Twitch video RSS" % display_name,
+        link='https://www.twitch.tv/' + channel_name,
+        description="The RSS Feed of %s's videos on Twitch" % display_name,
+        image=icon,
+        itunes_author="Twitch RSS Generated",
+        itunes_image=icon,
+        itunes_explicit='no',
+        itunes_complete=False,
+        itunes_summary="The RSS Feed of %s's videos on Twitch" % display_name)
     # Create an item
     if vods:
 
         try:
-            is_date = False
-            try:
-                parse_date(vods[0][sort_by])
-                is_date = True
-            except (ValueError, OverflowError, TypeError):
-                is_date = False
-
+            sort_values = [vod[sort_by] for vod in vods]
             logging.debug("ordering by: " + str(sort_by) + "; desc_sort=" + str(desc_sort))
-            if is_date:
-                vods = sorted(vods, key=lambda kv: parse_date(kv[sort_by]), reverse=desc_sort)
-            else:
+            if all(isinstance(value, str) and rss_writer.HELIX_TIMESTAMP.match(value) for value in sort_values):
+                # helix timestamps sort like their dates, no need to parse them
                 vods = sorted(vods, key=lambda kv: kv[sort_by], reverse=desc_sort)
+            else:
+                from dateutil.parser import parse as parse_date
+                is_date = False
+                try:
+                    parse_date(vods[0][sort_by])
+                    is_date = True
+                except (ValueError, OverflowError, TypeError):
+                    is_date = False
+
+                if is_date:
+                    vods = sorted(vods, key=lambda kv: parse_date(kv[sort_by]), reverse=desc_sort)
+                else:
+                    vods = sorted(vods, key=lambda kv: kv[sort_by], reverse=desc_sort)
         except KeyError:
             logging.error("can't order by " + sort_by + " resorting to ordering by id")
             sort_by = "published_at"
@@ -537,7 +1794,16 @@ def construct_rss(user, vods, streams, include_streams=False, sort_by="published
                 vods = sorted(vods, key=lambda kv: kv['id'], reverse=False)
             except KeyError:
                 logging.error("can't order by standard ordering")
-        for vod in vods:
+
+        audio_streams = {}
+        if not links_only and not transcode:
+            # resolve all the audio streams at once instead of one vod at a time
+            vod_urls = [vod['url'] for vod in vods if 'url' in vod
+                        and (include_streams or not is_streaming or vod.get('stream_id') != streams[0].get('id'))]
+            audio_streams = prefetch_audiostream_urls(vod_urls)
+
+        # the items are written last to first, the order feeds have always had
+        for vod in reversed(vods):
             try:
 
                 logging.debug("processing vod:" + vod['id'])
@@ -552,73 +1818,57 @@ def construct_rss(user, vods, streams, include_streams=False, sort_by="published
                         thumb = "https://vod-secure.twitch.tv/_404/404_processing_320x180.png"
                 else:
                     thumb = vod['thumbnail_url'].replace("%{width}", "512").replace("%{height}", "288")
-                item = feed.add_entry()
                 link = vod['url']
-                item.title(vod['title'])
 
                 description += "<a href=\"%s\"><p>%s</p><img src=\"%s\" /></a>" % (
                     link, html_escape(vod['title']), thumb)
                 if vod['description']:
                     description += "<br/>" + vod['description']
 
+                stream_url = None
+                enclosure_length = 0
+                duration = rss_writer.format_duration(vod['duration'])
+                # the playlist is more precise than the helix duration, but it's never downloaded just for the feed
+                playlist_duration = cached_duration(vod['id'])
+                if playlist_duration is not None:
+                    duration = rss_writer.format_seconds(playlist_duration)
                 if not links_only:
-                    # prevent get_audiostream_url to be run concurrenty with the same paramenter
-                    # this way the next hit on get_audiostream_url will use the cache instead
                     if not transcode:
-                        global streamUrl_queues
-                        if link not in streamUrl_queues:
-                            q = streamUrl_queues[link] = {'lock': RLock(), 'count': 0}
-                        else:
-                            q = streamUrl_queues[link]
-
-                        q['count'] = q['count'] + 1
-                        q['lock'].acquire()
-
-                        try:
-                            stream_url = get_audiostream_url(link)
-                        except NoAudioStreamException as e:
-                            description += "TwitchToPodcastRSS ERROR: could not fetch an audio stream for this vod,"
+                        stream_url, error = audio_streams[link]
+                        if error:
+                            description += AUDIO_ERROR_MESSAGE
                             description += "try refreshing the RSS feed later"
-                            description += "<br>reason: " + str(e)
-                            stream_url = None
-
-                        q['count'] = q['count'] - 1
-                        if q['count'] == 0:
-                            del streamUrl_queues[link]
-
-                        q['lock'].release()
+                            description += "<br>reason: " + str(error)
                     else:
-                        stream_url = url_for('transcode', vod_id = vod['id'], _external=True)
-
-                    if stream_url:
-                        item.enclosure(stream_url, type='audio/mpeg')
+                        if audio_format in REMUX_FORMATS:
+                            stream_url = url_for('remux', vod_id = vod['id'], audio_format = audio_format, _external=True)
+                        elif audio_format == 'ts':
+                            stream_url = url_for('proxy', vod_id = vod['id'], _external=True)
+                        else:
+                            stream_url = url_for('transcode', vod_id = vod['id'], profile = profile, _external=True)
+                            if playlist_duration is not None:
+                                enclosure_length = transcode_layouts[profile].length(playlist_duration)
 
                 description += '<br><br><p>Generated by <a href="https://github.com/'+ GITHUB_REPO + '" >TwitchToPodcastRSS</a></p>'
-                description += '<br><p>Last updated: ' + str(datetime.datetime.now()) + '</p>'
-                item.link(href=link, rel="related")
-                item.description(description)
-                date = datetime.datetime.strptime(vod['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-                duratio_str = re.sub('[hm]', ':', vod['duration']).replace('s', '')
-                duration_formatted = ':'.join([f'{int(i):02d}' for i in duratio_str.split(':')])
-                item.podcast.itunes_duration(duration_formatted)
-                item.podcast.itunes_author(channel_name)
-                if thumb.endswith('.jpg') or thumb.endswith('.png'):
-                    item.podcast.itunes_image(thumb)
-
-                item.pubDate(pytz.utc.localize(date))
-                item.updated(pytz.utc.localize(date))
-                guid = vod['id']
-                # if vod["status"] == "recording":  # To show a different news item when recording is over
-                # guid += "_live"
-                item.guid(guid)
+                yield rss_writer.item(
+                    title=vod['title'],
+                    description=description,
+                    guid=vod['id'],
+                    pub_date=rss_writer.parse_helix_timestamp(vod['created_at']),
+                    enclosure_url=stream_url,
+                    enclosure_type=AUDIO_MIMETYPES[audio_format] if transcode else 'audio/mpeg',
+                    enclosure_length=enclosure_length,
+                    itunes_author=channel_name,
+                    itunes_image=thumb if thumb.endswith('.jpg') or thumb.endswith('.png') else None,
+                    itunes_duration=duration)
             except KeyError as e:
                 logging.warning('Issue with json while processing vod: %s\n\nException: %s' % (vod, e))
-                feed.remove_entry(item)
 
     logging.debug("all vods processed")
-    return feed.rss_str()
+    yield rss_writer.close()
 
 
 # For debug
 if __name__ == "__main__":
+    warm_up()
     app.run(host='127.0.0.1', port=8081, debug=True)
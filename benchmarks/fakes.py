@@ -0,0 +1,187 @@
+"""
+File: fakes.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: local stand-ins for the helix API, streamlink and the twitch HLS servers, used by the benchmarks
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from functools import partial
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, urlsplit
+import datetime
+import json
+import os
+import re
+import subprocess
+import time
+import zlib
+
+# channels are named after their number of vods, for example bench500 has 500 vods
+CHANNEL_VODS = re.compile(r'^[a-z]+(\d+)$')
+DEFAULT_PAGE_SIZE = 20
+SEGMENT_SECONDS = 10
+
+
+def serve(server):
+    """runs the server in a daemon thread and returns its base url."""
+    Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://%s:%d' % server.server_address
+
+
+def user_id(login):
+    return str(zlib.crc32(login.encode()))
+
+
+def make_vods(login, count):
+    """returns count helix vods of the channel, the newest first, one per day."""
+    newest = datetime.datetime(2021, 6, 1, 20, 0, 0)
+    vods = []
+    for i in range(count):
+        created = (newest - datetime.timedelta(days=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        vod_id = str(100000000 + zlib.crc32(('%s%d' % (login, i)).encode()) % 900000000)
+        vods.append({
+            'id': vod_id, 'stream_id': str(40000000000 + i), 'user_id': user_id(login), 'user_login': login,
+            'user_name': login.capitalize(), 'title': 'stream number %d of %s & friends <3' % (count - i, login),
+            'description': 'vod %d' % i if i % 3 else '', 'created_at': created, 'published_at': created,
+            'url': 'https://www.twitch.tv/videos/' + vod_id,
+            'thumbnail_url': 'https://static-cdn.jtvnw.net/cf_vods/%s/thumb/thumb0-%%{width}x%%{height}.jpg' % vod_id,
+            'viewable': 'public', 'view_count': i * 7, 'language': 'en', 'type': 'archive',
+            'duration': '%dh%dm%ds' % (1 + i % 5, i % 60, i % 59)})
+    return vods
+
+
+class HelixHandler(BaseHTTPRequestHandler):
+    """answers the oauth token, users, streams and paginated videos requests like helix does."""
+
+    protocol_version = 'HTTP/1.1'
+    vods = {}
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_json({'access_token': 'benchmark', 'expires_in': 3600, 'token_type': 'bearer'})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path.endswith('/users'):
+            self.send_json({'data': [{'id': user_id(login), 'login': login, 'display_name': login.capitalize(),
+                                      'profile_image_url': 'https://static-cdn.jtvnw.net/%s-profile.png' % login}
+                                     for login in query.get('login', [])]})
+        elif url.path.endswith('/streams'):
+            self.send_json({'data': [], 'pagination': {}})
+        elif url.path.endswith('/videos'):
+            vods = self.vods.get(query['user_id'][0], [])
+            start = int(query.get('after', ['0'])[0])
+            end = start + int(query.get('first', [DEFAULT_PAGE_SIZE])[0])
+            self.send_json({'data': vods[start:end], 'pagination': {'cursor': str(end)} if end < len(vods) else {}})
+        else:
+            self.send_error(404)
+
+
+def helix_server(channels):
+    """starts the fake helix API.
+
+    Args:
+      channels: logins of the channels, each one has the number of vods in its name (bench500)
+
+    Returns: the base url of the server
+
+    """
+    HelixHandler.vods = {user_id(login): make_vods(login, int(CHANNEL_VODS.match(login).group(1))) for login in channels}
+    return serve(ThreadingHTTPServer(('127.0.0.1', 0), HelixHandler))
+
+
+def make_hls(directory, seconds, segment_format='ts'):
+    """writes an audio only twitch-like HLS vod of the given length (aac audio, one segment every 10 seconds) with ffmpeg.
+
+    Args:
+      directory: where the playlist and the segments are written
+      seconds: the length of the vod
+      segment_format: 'ts' for mpeg-ts segments like twitch, 'aac' for raw aac segments
+
+    Returns: the name of the playlist
+
+    """
+    muxer = {'ts': 'mpegts', 'aac': 'adts'}[segment_format]
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-f', 'lavfi',
+                    '-i', 'sine=frequency=440:sample_rate=48000:duration=%d' % seconds, '-ac', '2', '-c:a', 'aac', '-b:a', '160k',
+                    '-f', 'segment', '-segment_time', str(SEGMENT_SECONDS), '-segment_format', muxer,
+                    '-segment_list', os.path.join(directory, 'audio.m3u8'), '-segment_list_type', 'm3u8',
+                    os.path.join(directory, 'segment%d.' + segment_format)],
+                   check=True)
+    # the tag twitch uses for the total length of the vod
+    with open(os.path.join(directory, 'audio.m3u8')) as playlist:
+        lines = playlist.read().splitlines()
+    lines.insert(1, '#EXT-X-TWITCH-TOTAL-SECS:%d' % seconds)
+    with open(os.path.join(directory, 'audio.m3u8'), 'w') as playlist:
+        playlist.write('\n'.join(lines) + '\n')
+    return 'audio.m3u8'
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg is killed in the middle of a download when a listener goes away
+            pass
+
+
+def hls_server(directory):
+    """serves the files of directory, returns the base url of the server."""
+    return serve(ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory)))
+
+
+class StubStream:
+    def __init__(self, url):
+        self.url = url
+
+    def to_url(self):
+        return self.url
+
+
+class StubStreamlink:
+    """replaces the streamlink session: every vod has the same local audio playlist."""
+
+    def __init__(self, playlist_url, delay=0.05):
+        """
+        Args:
+          playlist_url: the url returned for every vod
+          delay: seconds a lookup takes, like the twitch API calls streamlink makes
+        """
+        self.playlist_url = playlist_url
+        self.delay = delay
+
+    def streams(self, url):
+        time.sleep(self.delay)
+        return {'audio': StubStream(self.playlist_url)}
@@ -0,0 +1,181 @@
+"""
+File: golden.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: compares the feeds written by construct_rss with the ones feedgen wrote before rss_writer replaced it
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# usage: python benchmarks/golden.py
+#
+# the files in golden/ were written once by the feedgen 0.9.0 version of construct_rss, with the same
+# cases and the same streamlink stand-in. Only lastBuildDate is left out of the comparison (the
+# "Last updated" stamp feedgen feeds had in the descriptions was removed from the fixtures too).
+# The exit code is 1 when a feed differs.
+
+import argparse
+import os
+import re
+import sys
+
+GOLDEN_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TwitchRSS')
+BASE_URL = 'http://localhost/'
+LAST_BUILD_DATE = re.compile(rb'<lastBuildDate>[^<]*</lastBuildDate>')
+# vods whose audio stream can't be found
+MISSING_AUDIO = {'700000004'}
+
+USER = {'id': '70', 'login': 'golden', 'display_name': 'Golden', 'profile_image_url': 'https://static/golden/profile.png'}
+SORT_KEYS = ['published_at', 'created_at', 'view_count', 'title', 'id', 'duration', 'missing_key']
+TEXTS = ['plain title', 'fish & chips', '<b>bold</b> "quoted" \'single\'', 'cdata ]]> end', 'tab\tand\nnewline',
+         'carriage\rreturn', 'emoji \U0001F600 and accents éè', '100% {braces}', '', '   spaces   ']
+
+
+class GoldenStream:
+    def __init__(self, url):
+        self.url = url
+
+    def to_url(self):
+        return self.url
+
+
+class GoldenStreamlink:
+    """streamlink stand-in: every vod has its own audio url, the ones in MISSING_AUDIO have none."""
+
+    def streams(self, url):
+        vod_id = url.rsplit('/', 1)[1]
+        if vod_id in MISSING_AUDIO:
+            return {}
+        return {'audio': GoldenStream('https://hls.golden/%s/audio_only/index-dvr.m3u8' % vod_id)}
+
+
+def make_vods(count):
+    """returns count helix vods whose fields cover the escaping and sorting cases."""
+    vods = []
+    for i in range(count):
+        vods.append({
+            'id': str(700000000 + i),
+            'stream_id': str(800000000 + i),
+            'user_id': USER['id'],
+            'user_login': USER['login'],
+            'user_name': USER['display_name'],
+            'title': TEXTS[i % len(TEXTS)] or 'untitled',
+            'description': TEXTS[(i * 3) % len(TEXTS)],
+            'created_at': '2021-%02d-%02dT%02d:%02d:00Z' % (1 + (i * 5) % 12, 1 + (i * 7) % 28, (i * 3) % 24, (i * 11) % 60),
+            'published_at': '2021-%02d-%02dT%02d:00:00Z' % (1 + (i * 7) % 12, 1 + (i * 5) % 28, (i * 5) % 24),
+            'url': 'https://www.twitch.tv/videos/%d' % (700000000 + i),
+            'thumbnail_url': 'https://static/golden/%d-%%{width}x%%{height}.%s' % (i, 'jpeg' if i % 4 == 3 else 'jpg'),
+            'viewable': 'public',
+            'view_count': (i * 37) % 11,
+            'language': 'en',
+            'type': 'archive',
+            'duration': ['%dh%dm%ds' % (i % 4, (i * 13) % 60, (i * 7) % 60), '%dm%ds' % ((i * 13) % 60, i % 60), '%ds' % (i % 60)][i % 3],
+        })
+    return vods
+
+
+def cases():
+    """returns the (name, user, vods, streams, options) of every golden feed."""
+    vods = make_vods(12)
+    live = [{'id': vods[0]['stream_id']}]
+    special_user = dict(USER, display_name='Fish & <Chips> "é"', profile_image_url='https://static/golden/a&b.jpg')
+    result = [
+        ('empty', USER, [], [], {}),
+        ('escaping', special_user, vods, [], {'links_only': True}),
+        ('live_skipped', USER, vods, live, {'links_only': True}),
+        ('live_included', USER, vods, live, {'include_streams': True, 'links_only': True}),
+        ('audio_streams', USER, vods, live, {'include_streams': True, 'transcode': False}),
+        ('transcode_mp3', USER, vods, [], {'transcode': True, 'audio_format': 'mp3'}),
+        ('transcode_aac', USER, vods, [], {'transcode': True, 'audio_format': 'aac'}),
+        ('transcode_m4a', USER, vods, live, {'transcode': True, 'audio_format': 'm4a'}),
+        ('transcode_ts', USER, vods, [], {'transcode': True, 'audio_format': 'ts'}),
+    ]
+    for sort_by in SORT_KEYS:
+        for desc_sort in (False, True):
+            result.append(('sort_%s%s' % (sort_by, '_desc' if desc_sort else ''), USER, vods, [],
+                           {'sort_by': sort_by, 'desc_sort': desc_sort, 'links_only': True}))
+    return result
+
+
+def load_app():
+    """imports twitchrss configured for the comparison."""
+    for name in ('CACHE_DB', 'TRANSCODE_CACHE_DIR', 'BACKGROUND_REFRESH', 'SERVER_NAME', 'SUB_FOLDER'):
+        os.environ.pop(name, None)
+    os.environ.setdefault('TWITCH_CLIENT_ID', 'golden')
+    os.environ.setdefault('TWITCH_SECRET', 'golden')
+    os.environ['WARM_UP'] = 'False'
+    sys.path.insert(0, APP_DIRECTORY)
+    import twitchrss
+    return twitchrss
+
+
+def write_feeds(app, construct_rss=None):
+    """returns the {name: feed bytes} of every case.
+
+    Args:
+      app: the twitchrss module
+      construct_rss: the function writing a feed, the one of app if None
+
+    """
+    construct_rss = construct_rss or (lambda *args, **kwargs: app.rss_writer.encode(app.construct_rss(*args, **kwargs))[0])
+    session = app.streamlink_session
+    app.streamlink_session = GoldenStreamlink()
+    try:
+        feeds = {}
+        for name, user, vods, streams, options in cases():
+            options = dict({'transcode': False}, **options)
+            with app.app.test_request_context('/vod/' + user['login'], base_url=BASE_URL):
+                feeds[name] = construct_rss(user, vods, streams, **options)
+        return feeds
+    finally:
+        app.streamlink_session = session
+
+
+def first_difference(expected, actual):
+    """returns the text around the first byte where the two feeds differ."""
+    index = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual)))
+    return "expected %r, got %r" % (expected[max(0, index - 40):index + 40], actual[max(0, index - 40):index + 40])
+
+
+def run(app):
+    """compares the feeds of app with the golden files.
+
+    Returns: the number of cases and the {name: difference} of the feeds that don't match
+
+    """
+    mismatches = {}
+    feeds = write_feeds(app)
+    for name, feed in feeds.items():
+        with open(os.path.join(GOLDEN_DIRECTORY, name + '.xml'), 'rb') as golden:
+            expected = LAST_BUILD_DATE.sub(b'', golden.read())
+        actual = LAST_BUILD_DATE.sub(b'', feed)
+        if actual != expected:
+            mismatches[name] = first_difference(expected, actual)
+    return {'cases': len(feeds), 'mismatches': mismatches}
+
+
+def main():
+    argparse.ArgumentParser(description="compares the feeds with the ones written by feedgen").parse_args()
+    results = run(load_app())
+    for name, difference in sorted(results['mismatches'].items()):
+        print("FAIL: %s: %s" % (name, difference))
+    print("%d of %d feeds match" % (results['cases'] - len(results['mismatches']), results['cases']))
+    sys.exit(1 if results['mismatches'] else 0)
+
+
+if __name__ == '__main__':
+    main()
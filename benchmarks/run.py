@@ -0,0 +1,309 @@
+"""
+File: run.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: offline benchmark suite, measures feeds and transcodes against local stand-ins of twitch and writes the results as JSON
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# usage: python benchmarks/run.py [--output results.json] [--baseline old_results.json] [--quick]
+#
+# startup.py checks the cold start on its own, here its measures are only recorded.
+# nothing is sent to twitch: helix, streamlink and the HLS servers are replaced by the stand-ins in
+# fakes.py, only the transcode benchmarks need ffmpeg. With --baseline the results are compared to a previous run.
+# golden.py checks the feeds against the golden files first, the run fails if they differ.
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakes
+import golden
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CHANNELS = ['bench20', 'bench100', 'bench500']
+THROUGHPUT_CHANNEL = 'bench100'
+CONCURRENCY = [1, 4, 16]
+# the feeds only link the audio playlist, transcode_latency serves a real one
+FEED_PLAYLIST_URL = 'http://127.0.0.1/unused/index-dvr.m3u8'
+# the values compared with --baseline, with True if higher is better
+COMPARED = {'median_ms': False, 'p95_ms': False, 'requests_per_second': True, 'mb_per_cpu_second': True}
+
+
+def setup(streamlink_delay):
+    """starts the helix stand-in and imports the app configured to use it.
+
+    Returns: the twitchrss module and the temporary directory of the run
+
+    """
+    directory = tempfile.mkdtemp(prefix='twitchrss-benchmark-')
+    helix_url = fakes.helix_server(CHANNELS)
+    for name in ('CACHE_DB', 'TRANSCODE_CACHE_DIR', 'BACKGROUND_REFRESH', 'SERVER_NAME', 'SUB_FOLDER', 'DEBUG'):
+        os.environ.pop(name, None)
+    os.environ.update({
+        'TWITCH_CLIENT_ID': 'benchmark',
+        'TWITCH_SECRET': 'benchmark',
+        'TWITCH_API_URL': helix_url + '/helix/',
+        'TWITCH_AUTH_URL': helix_url + '/oauth2/token',
+        'TWITCH_RATE_LIMIT': '1000000',
+        'FULL_VOD_HISTORY': 'True',
+        'TRANSCODE_MAX_CONCURRENT': '64',
+        'TRANSCODE_MAX_QUEUE': '64',
+    })
+    sys.path.insert(0, os.path.join(ROOT, 'TwitchRSS'))
+    import twitchrss
+    logging.getLogger().setLevel(logging.WARNING)
+    twitchrss.streamlink_session = fakes.StubStreamlink(FEED_PLAYLIST_URL, streamlink_delay)
+    return twitchrss, directory
+
+
+def summarize(seconds):
+    """returns the statistics of a list of durations in milliseconds."""
+    ordered = sorted(seconds)
+    return {
+        'runs': len(ordered),
+        'median_ms': round(ordered[len(ordered) // 2] * 1000, 2),
+        'p95_ms': round(ordered[max(0, math.ceil(len(ordered) * 0.95) - 1)] * 1000, 2),
+        'min_ms': round(ordered[0] * 1000, 2),
+        'max_ms': round(ordered[-1] * 1000, 2),
+    }
+
+
+def timed(request):
+    """runs request and returns its duration, the response must be successful."""
+    start = time.time()
+    response = request()
+    elapsed = time.time() - start
+    if response.status_code >= 400:
+        raise Exception("benchmark request failed with code %d" % response.status_code)
+    return elapsed
+
+
+def clear_caches(app):
+    for name, cache in app.caches.items():
+        with app.cache_locks[name]:
+            cache.clear()
+
+
+def feed_latency(app, repeats, cold_repeats):
+    """latency of a feed request with nothing cached, with the twitch data cached
+    (the feed is written again) and with the feed cached, for every channel size."""
+    results = {}
+    hosts = itertools.count()
+    for channel in CHANNELS:
+        client = app.app.test_client()
+        path = '/vod/' + channel
+        cold = []
+        for _ in range(cold_repeats):
+            clear_caches(app)
+            cold.append(timed(lambda: client.get(path)))
+        # the host is part of the feed key, a new host writes the feed again from the cached data
+        data_cached = [timed(lambda: client.get(path, base_url='http://host%d.benchmark/' % next(hosts)))
+                       for _ in range(repeats)]
+        feed_cached = [timed(lambda: client.get(path)) for _ in range(repeats)]
+        results[channel] = {
+            'vods': int(fakes.CHANNEL_VODS.match(channel).group(1)),
+            'cold': summarize(cold),
+            'data_cached': summarize(data_cached),
+            'feed_cached': summarize(feed_cached),
+        }
+    return results
+
+
+def feed_throughput(app, seconds):
+    """feed requests per second served by the app with more threads asking at once."""
+    path = '/vod/' + THROUGHPUT_CHANNEL
+    app.app.test_client().get(path)
+    hosts = itertools.count()
+    results = {}
+    for state in ('feed_cached', 'data_cached'):
+        results[state] = {}
+        for threads in CONCURRENCY:
+            deadline = time.time() + seconds
+
+            def worker():
+                client = app.app.test_client()
+                latencies = []
+                while time.time() < deadline:
+                    if state == 'feed_cached':
+                        latencies.append(timed(lambda: client.get(path)))
+                    else:
+                        latencies.append(timed(lambda: client.get(path, base_url='http://host%d.benchmark/' % next(hosts))))
+                return latencies
+
+            start = time.time()
+            with ThreadPoolExecutor(threads) as pool:
+                latencies = sum(pool.map(lambda _: worker(), range(threads)), [])
+            elapsed = time.time() - start
+            results[state]['%d_threads' % threads] = dict(summarize(latencies),
+                                                          requests_per_second=round(len(latencies) / elapsed, 1))
+    return results
+
+
+def first_byte(app, path, headers=None):
+    """returns the seconds until the first byte of the body, then hangs up like a player seeking elsewhere."""
+    client = app.app.test_client()
+    start = time.time()
+    response = client.get(path, headers=headers or {}, buffered=False)
+    try:
+        if response.status_code >= 400:
+            raise Exception("benchmark request failed with code %d" % response.status_code)
+        for chunk in response.response:
+            if chunk:
+                break
+        return time.time() - start, response.headers.get('Content-Range')
+    finally:
+        response.close()
+
+
+def transcode_latency(app, repeats, directory, hls_seconds, segment_format):
+    """time to first byte of a transcode: of a new vod, of a vod whose playlist is cached,
+    of a seek to the middle, and the same from a complete file of the transcode cache.
+
+    the HLS vod every transcode reads is made here, so the other benchmarks don't need ffmpeg."""
+    playlist = fakes.make_hls(directory, hls_seconds, segment_format)
+    app.streamlink_session.playlist_url = fakes.hls_server(directory) + '/' + playlist
+    clear_caches(app)
+    new_vod, start, seek = [], [], []
+    for i in range(repeats):
+        vod_id = str(900000 + i)
+        elapsed, _ = first_byte(app, '/transcode/%s.mp3' % vod_id)
+        new_vod.append(elapsed)
+        elapsed, _ = first_byte(app, '/transcode/%s.mp3' % vod_id)
+        start.append(elapsed)
+        length = app.transcode_layouts[app.DEFAULT_TRANSCODE_PROFILE].length(app.get_playlist(vod_id).duration)
+        elapsed, _ = first_byte(app, '/transcode/%s.mp3' % vod_id, {'Range': 'bytes=%d-' % (length // 2)})
+        seek.append(elapsed)
+    results = {'uncached': {'new_vod': summarize(new_vod), 'start': summarize(start), 'seek': summarize(seek)}}
+
+    uncached = app.transcode_cache
+    app.transcode_cache = app.TranscodeCache(os.path.join(directory, 'transcodes'), 1024 * 1024 * 1024)
+    try:
+        vod_id = '990000'
+        started = time.time()
+        app.app.test_client().get('/transcode/%s.mp3' % vod_id)
+        cache_name = app.transcode_cache_name(vod_id, app.transcode_layouts[app.DEFAULT_TRANSCODE_PROFILE])
+        while not app.transcode_cache.complete_path(cache_name):
+            if app.transcode_cache.needs_writer(cache_name):
+                raise Exception("the cached transcode failed")
+            time.sleep(0.05)
+        results['cache_fill_seconds'] = round(time.time() - started, 2)
+        length = os.path.getsize(app.transcode_cache.path(cache_name))
+        cached_start = [first_byte(app, '/transcode/%s.mp3' % vod_id)[0] for _ in range(repeats)]
+        cached_seek = [first_byte(app, '/transcode/%s.mp3' % vod_id, {'Range': 'bytes=%d-' % (length // 2)})[0]
+                       for _ in range(repeats)]
+        results['cached'] = {'start': summarize(cached_start), 'seek': summarize(cached_seek)}
+    finally:
+        app.transcode_cache = uncached
+    return results
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=''):
+    """returns the compared values of the results as a {'path.to.value': value} dict."""
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, prefix + key + '.'))
+        elif key in COMPARED:
+            values[prefix + key] = value
+    return values
+
+
+def compare(baseline, current):
+    """prints how much every value changed from the baseline results."""
+    old = flatten(baseline['results'])
+    new = flatten(current['results'])
+    print("compared to %s (%s)" % (baseline.get('version'), baseline.get('created')))
+    for path in sorted(set(old) & set(new)):
+        if not old[path]:
+            continue
+        change = (new[path] - old[path]) / old[path] * 100
+        better = change > 0 if COMPARED[path.rsplit('.', 1)[1]] else change < 0
+        print("%-70s %10s -> %10s %+7.1f%% %s" % (path, old[path], new[path], change, 'better' if better else 'worse'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline benchmarks of TwitchToPodcastRSS")
+    parser.add_argument('--output', help="file the JSON results are written to, stdout if missing")
+    parser.add_argument('--baseline', help="JSON results of a previous run to compare with")
+    parser.add_argument('--quick', action='store_true', help="fewer repetitions, for a fast check")
+    parser.add_argument('--segments', choices=['ts', 'aac'], default='ts',
+                        help="container of the HLS segments, aac for ffmpeg builds that can't demux mpeg-ts")
+    args = parser.parse_args()
+
+    repeats, cold_repeats, seconds, megabytes = (3, 1, 1, 64) if args.quick else (10, 3, 3, 256)
+    settings = {'repeats': repeats, 'cold_repeats': cold_repeats, 'throughput_seconds': seconds,
+                'hls_seconds': 600, 'segments': args.segments, 'streamlink_delay': 0.02, 'output_megabytes': megabytes}
+    app, directory = setup(settings['streamlink_delay'])
+    try:
+        import startup
+        import transcode_output
+        results = {
+            'startup': startup.run(repeats),
+            'golden_feed': golden.run(app),
+            'feed_latency': feed_latency(app, repeats, cold_repeats),
+            'feed_throughput': feed_throughput(app, seconds),
+            'transcode_latency': transcode_latency(app, repeats, directory, settings['hls_seconds'], args.segments),
+            'transcode_output': {result.pop('name'): result for result in transcode_output.run(megabytes)},
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        'version': git_version(),
+        'created': datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'settings': settings,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(json.load(baseline), report)
+    for name, difference in sorted(results['golden_feed']['mismatches'].items()):
+        print("FAIL: golden feed %s: %s" % (name, difference))
+    if results['golden_feed']['mismatches']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+File: startup.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: measures the cold start of a worker and checks it against a time budget
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# usage: python benchmarks/startup.py [--budget SECONDS] [--runs N]
+#
+# every measure runs in a new python process, like a freshly started container. The import of
+# twitchrss must fit in the budget without loading streamlink, and a worker started on a warm
+# CACHE_DB must answer the index and a cached feed before streamlink is loaded.
+# The exit code is 1 when a check fails.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import fakes
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TwitchRSS')
+# seconds, the import on a small cloud instance with the docker image
+DEFAULT_BUDGET = 1.0
+FEED_CHANNEL = 'bench20'
+
+IMPORT_CODE = """
+import json, sys, time
+start = time.perf_counter()
+import twitchrss
+print(json.dumps({'seconds': time.perf_counter() - start, 'streamlink_loaded': 'streamlink' in sys.modules}))
+"""
+
+# fills the cache database with the feed, streamlink is replaced so it's never loaded here either
+FILL_CACHE_CODE = """
+import sys
+sys.path.insert(0, %r)
+import fakes, twitchrss
+twitchrss.streamlink_session = fakes.StubStreamlink('http://127.0.0.1:9/audio.m3u8', 0)
+assert twitchrss.app.test_client().get('/vod/%s').status_code == 200
+""" % (os.path.dirname(os.path.abspath(__file__)), FEED_CHANNEL)
+
+FIRST_REQUESTS_CODE = """
+import json, sys, time
+start = time.perf_counter()
+import twitchrss
+client = twitchrss.app.test_client()
+results = {}
+for name, path in (('index', '/'), ('cached_feed', '/vod/%s')):
+    status = client.get(path).status_code
+    results[name] = {'status': status, 'seconds_since_start': time.perf_counter() - start}
+results['streamlink_loaded'] = 'streamlink' in sys.modules
+print(json.dumps(results))
+""" % FEED_CHANNEL
+
+
+def run_python(code, env):
+    """runs code in a new interpreter from the app directory, returns its last output line parsed as JSON."""
+    output = subprocess.run([sys.executable, '-c', code], cwd=APP_DIRECTORY, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, check=True).stdout.decode()
+    lines = output.strip().splitlines()
+    return json.loads(lines[-1]) if lines else None
+
+
+def app_environment(**extra):
+    env = dict(os.environ, TWITCH_CLIENT_ID='benchmark', TWITCH_SECRET='benchmark', **extra)
+    for name in ('CACHE_DB', 'TRANSCODE_CACHE_DIR', 'BACKGROUND_REFRESH', 'PRETRANSCODE'):
+        if name not in extra:
+            env.pop(name, None)
+    return env
+
+
+def run(runs):
+    """measures the import time and the first requests of a new worker.
+
+    Returns: the results, with the median of the runs
+
+    """
+    imports = [run_python(IMPORT_CODE, app_environment()) for _ in range(runs)]
+    seconds = sorted(result['seconds'] for result in imports)
+
+    helix_url = fakes.helix_server([FEED_CHANNEL])
+    with tempfile.TemporaryDirectory() as directory:
+        env = app_environment(CACHE_DB=os.path.join(directory, 'cache.sqlite'), TWITCH_API_URL=helix_url + '/helix/',
+                              TWITCH_AUTH_URL=helix_url + '/oauth2/token')
+        run_python(FILL_CACHE_CODE, env)
+        first_requests = [run_python(FIRST_REQUESTS_CODE, env) for _ in range(runs)]
+
+    def median(values):
+        return round(sorted(values)[len(values) // 2] * 1000, 2)
+
+    return {
+        'import': {'runs': runs, 'median_ms': median(seconds), 'min_ms': round(seconds[0] * 1000, 2),
+                   'streamlink_loaded': any(result['streamlink_loaded'] for result in imports)},
+        'first_requests': {
+            'index': {'median_ms': median([result['index']['seconds_since_start'] for result in first_requests]),
+                      'status': first_requests[0]['index']['status']},
+            'cached_feed': {'median_ms': median([result['cached_feed']['seconds_since_start'] for result in first_requests]),
+                            'status': first_requests[0]['cached_feed']['status']},
+            'streamlink_loaded': any(result['streamlink_loaded'] for result in first_requests),
+        },
+    }
+
+
+def check(results, budget):
+    """returns the list of failed checks."""
+    failures = []
+    if results['import']['median_ms'] > budget * 1000:
+        failures.append("importing twitchrss took %.0f ms, the budget is %.0f ms" % (results['import']['median_ms'], budget * 1000))
+    if results['import']['streamlink_loaded']:
+        failures.append("importing twitchrss loads streamlink")
+    for name in ('index', 'cached_feed'):
+        if results['first_requests'][name]['status'] != 200:
+            failures.append("the %s answered %d" % (name, results['first_requests'][name]['status']))
+    if results['first_requests']['streamlink_loaded']:
+        failures.append("the index or the cached feed loaded streamlink")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cold start check of TwitchToPodcastRSS")
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET, help="seconds the import of twitchrss may take")
+    parser.add_argument('--runs', type=int, default=5, help="new processes started for every measure")
+    args = parser.parse_args()
+
+    results = run(args.runs)
+    print(json.dumps(results, indent=2))
+    failures = check(results, args.budget)
+    for failure in failures:
+        print("FAIL: " + failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
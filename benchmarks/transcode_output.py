@@ -0,0 +1,154 @@
+"""
+File: transcode_output.py
+Author: Mattia Di Eleuterio
+Github: https://github.com/madiele/TwitchToPodcastRSS
+Description: measures how many bytes per second of cpu the transcode output path can stream, before and after reading with readinto
+"""
+
+# Copyright 2021 Mattia Di Eleuterio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# usage: python benchmarks/transcode_output.py [MEGABYTES]
+#
+# ffmpeg is replaced by a process writing zeros as fast as it can, so only the python side of the
+# stream is measured: the cpu time of this process divided by the bytes streamed gives the bytes
+# per second a single core can send to the listeners.
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TwitchRSS'))
+os.environ.setdefault('TWITCH_CLIENT_ID', 'benchmark')
+os.environ.setdefault('TWITCH_SECRET', 'benchmark')
+
+import twitchrss  # noqa: E402
+from transcode_cache import TranscodeCache  # noqa: E402
+from transcode_scheduler import TranscodeScheduler  # noqa: E402
+
+PRODUCER = "import sys; out = sys.stdout.buffer; chunk = bytes(64 * 1024); [out.write(chunk) for _ in range(%d)]"
+
+
+def start_producer(megabytes, bufsize):
+    return subprocess.Popen([sys.executable, '-c', PRODUCER % (megabytes * 16)], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, bufsize=bufsize)
+
+
+def legacy_output(process, scheduler, slot):
+    """the transcode loop before readinto: 1 KB reads, a list used as a queue, activity and poll at every chunk."""
+    buff = []
+    while True:
+        line = process.stdout.read(1024)
+        buff.append(line)
+        scheduler.touch(slot)
+        yield buff.pop(0)
+        process.poll()
+        if isinstance(process.returncode, int):
+            break
+
+
+def current_output(process, scheduler, slot):
+    """the transcode loop of twitchrss.transcode()."""
+    touched = time.time()
+    for data in twitchrss.read_pipe(process.stdout):
+        now = time.time()
+        if now - touched > twitchrss.TRANSCODE_ACTIVITY_INTERVAL:
+            scheduler.touch(slot)
+            touched = now
+        yield data
+    process.wait()
+
+
+def measure(name, run):
+    """runs run(), which returns the bytes it streamed, and returns its throughput."""
+    cpu = time.process_time()
+    wall = time.time()
+    streamed = run()
+    cpu = time.process_time() - cpu
+    wall = time.time() - wall
+    return {'name': name, 'megabytes': round(streamed / 1024 / 1024, 1), 'cpu_seconds': round(cpu, 3),
+            'wall_seconds': round(wall, 3), 'mb_per_cpu_second': round(streamed / 1024 / 1024 / cpu, 1)}
+
+
+def bench_pipe(name, megabytes, output, bufsize):
+    scheduler = TranscodeScheduler(1, 1, 1, 600)
+    slot = scheduler.acquire(name, 0)
+
+    def run():
+        process = start_producer(megabytes, bufsize)
+        streamed = sum(len(data) for data in output(process, scheduler, slot))
+        process.wait()
+        return streamed
+    return measure(name, run)
+
+
+def bench_cached_file(megabytes):
+    """sends a complete cached transcode to a pipe, with the python reads of tail() and with sendfile."""
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        cache = TranscodeCache(directory, 2 * megabytes * 1024 * 1024)
+        with open(cache.path('vod.mp3'), 'wb') as output:
+            output.write(bytes(megabytes * 1024 * 1024))
+
+        def tail():
+            sink = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+            streamed = 0
+            for data in cache.tail('vod.mp3'):
+                sink.stdin.write(data)
+                streamed += len(data)
+            sink.stdin.close()
+            sink.wait()
+            return streamed
+
+        def sendfile():
+            sink = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+            # what gunicorn does with the file returned by send_file()
+            source = open(cache.path('vod.mp3'), 'rb')
+            streamed = 0
+            with source:
+                size = os.fstat(source.fileno()).st_size
+                while streamed < size:
+                    streamed += os.sendfile(sink.stdin.fileno(), source.fileno(), streamed, size - streamed)
+            sink.stdin.close()
+            sink.wait()
+            return streamed
+
+        results.append(measure('cached file, tail()', tail))
+        if hasattr(os, 'sendfile'):
+            results.append(measure('cached file, sendfile', sendfile))
+    return results
+
+
+def run(megabytes):
+    """runs every measure streaming megabytes of data, returns their results."""
+    return [
+        bench_pipe('ffmpeg pipe, before (read 1 KB)', megabytes, legacy_output, -1),
+        bench_pipe('ffmpeg pipe, after (readinto 64 KB)', megabytes, current_output, 0),
+    ] + bench_cached_file(megabytes)
+
+
+def main():
+    results = run(int(sys.argv[1]) if len(sys.argv) > 1 else 256)
+    for result in results:
+        print("%-40s %8.1f MB/s per core (%.2fs cpu, %.2fs wall)" % (
+            result['name'], result['mb_per_cpu_second'], result['cpu_seconds'], result['wall_seconds']))
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()